@@ -0,0 +1,286 @@
+# importing libaraies
+import hashlib
+import json
+import math
+import os
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import geopandas as gp
+import rasterio
+from rasterio.warp import transform_bounds
+from shapely.geometry import mapping, shape
+from shapely.geometry.polygon import orient
+from shapely.ops import transform as transform_geometry
+
+# The clipping, index and statistics code of the pipeline
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+from bandstack import BandStack
+from catalog import Catalog
+from clipping import clip_raster
+from indices import INDICES, process_indices, required_bands
+from zonal import zonal_stats
+
+# Decimals of the WGS84 coordinates kept when hashing a geometry (about 1 cm)
+GEOMETRY_DECIMALS = 7
+# Largest area accepted, in square degrees (about 50 x 50 km at mid latitudes)
+MAX_AREA = 0.3
+# Seconds after which a queued or running job that was not updated is taken as abandoned (its
+# worker process died) and started again by the next request
+JOB_TIMEOUT = 15 * 60
+
+
+def geometry_from_json(data):
+    """
+    Read a GeoJSON Polygon or MultiPolygon, or a Feature holding one, in WGS84.
+
+    Raises:
+        ValueError: If it is not a valid polygon or is too large.
+    """
+    if data.get('type') == 'Feature':
+        data = data.get('geometry') or {}
+    if data.get('type') not in ('Polygon', 'MultiPolygon'):
+        raise ValueError("The geometry must be a GeoJSON Polygon or MultiPolygon")
+    geometry = shape(data)
+    if geometry.is_empty or not geometry.is_valid:
+        raise ValueError("The polygon is empty or not valid")
+    if geometry.area > MAX_AREA:
+        raise ValueError("The polygon is too large for an on-demand computation")
+    return geometry
+
+
+def geometry_hash(geometry):
+    # Same hash for the same polygon drawn again, whatever the ring orientation and float noise
+    rounded = transform_geometry(lambda x, y, z=None: (round(x, GEOMETRY_DECIMALS), round(y, GEOMETRY_DECIMALS)),
+                                 geometry)
+    if rounded.geom_type == 'Polygon':
+        rounded = orient(rounded)
+    else:
+        rounded = type(rounded)([orient(polygon) for polygon in rounded.geoms])
+    return hashlib.sha1(rounded.wkb).hexdigest()
+
+
+def _json_value(value):
+    # NaN is not valid JSON
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    return value.item() if hasattr(value, 'item') else value
+
+
+class OnDemandJobs:
+    """
+    Computes an index and its statistics over a user-drawn polygon in background threads.
+
+    A request is identified by (product, geometry hash, index, cloud mask), which is also the id of
+    its job, so repeated requests share one job and one result. All the state is kept in the cache
+    folder, so every worker process of the app sees the jobs of the others: <id>.job.json holds a
+    queued, running or failed job, and a finished job leaves <id>.tif (the index clipped to the
+    polygon) and <id>.json (the request and the statistics), which survive restarts. A polygon
+    inside the polygon of a cached result of the same product and index is computed from that
+    result instead of the source bands. The source bands of a product are found in the catalog of
+    the pipeline.
+
+    Args:
+        catalog_path (str): Path of the catalog.sqlite of the pipeline data folder.
+        cache_folder (str): Folder of the cached results and of the job files.
+        workers (int): Jobs computed at the same time by this process.
+    """
+
+    def __init__(self, catalog_path, cache_folder, workers=2):
+        self.catalog_path = catalog_path
+        self.cache_folder = cache_folder
+        self.workers = workers
+        self._catalog = None
+        self._executor = None
+        self._results = {}
+        self._listed = None
+        self._lock = threading.Lock()
+
+    def _result_path(self, job_id):
+        return os.path.join(self.cache_folder, f'{job_id}.json')
+
+    def _job_path(self, job_id):
+        return os.path.join(self.cache_folder, f'{job_id}.job.json')
+
+    def raster_path(self, job_id):
+        return os.path.join(self.cache_folder, f'{job_id}.tif')
+
+    def _load_results(self):
+        # Results of the cache folder by id, listed again when the folder changed (another worker
+        # process may have finished a job)
+        try:
+            listed = os.stat(self.cache_folder).st_mtime_ns
+        except FileNotFoundError:
+            return self._results
+        if listed != self._listed:
+            self._listed = listed
+            for name in os.listdir(self.cache_folder):
+                job_id = name[:-len('.json')]
+                if name.endswith('.json') and not name.endswith('.job.json') and job_id not in self._results:
+                    self._read_result(job_id)
+        return self._results
+
+    def _read_result(self, job_id):
+        try:
+            with open(self._result_path(job_id)) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        result['shape'] = shape(result['geometry'])
+        self._results[job_id] = result
+        return result
+
+    def _find_result(self, job_id):
+        # Results written by other worker processes are found even before the folder is listed again
+        return self._results.get(job_id) or self._read_result(job_id)
+
+    def _read_job(self, job_id):
+        try:
+            with open(self._job_path(job_id)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write_job(self, job):
+        job['updated'] = time.time()
+        path = self._job_path(job['id'])
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+    def _active(self, job):
+        # A job queued or running in some worker process; it is abandoned when its process died
+        return (job is not None and job['status'] in ('queued', 'running')
+                and time.time() - job.get('updated', 0) < JOB_TIMEOUT)
+
+    def band_files(self, product_id):
+        with self._lock:
+            if self._catalog is None:
+                self._catalog = Catalog(self.catalog_path)
+        return self._catalog.band_files(product_id)
+
+    def submit(self, geometry, product_id, index, cloud_mask=True):
+        """
+        Start the computation of an index over a polygon, unless it is cached or already running.
+
+        Args:
+            geometry: Shapely polygon in WGS84, see geometry_from_json.
+            product_id (str): Id of the product, as in sa.image_meta.
+            index (str): Index name, key of indices.INDICES.
+            cloud_mask (bool): Leave out the pixels of clouds and cloud shadows.
+
+        Returns:
+            dict: The job.
+
+        Raises:
+            KeyError: If the index is unknown.
+            FileNotFoundError: If the bands of the product are not available locally.
+        """
+        if index not in INDICES:
+            raise KeyError(index)
+        job_id = hashlib.sha1(f'{product_id}|{index}|{bool(cloud_mask)}|{geometry_hash(geometry)}'.encode()).hexdigest()[:20]
+        with self._lock:
+            result = self._find_result(job_id)
+        if result is not None:
+            return self._job(result, 'done')
+        current = self._read_job(job_id)
+        if self._active(current):
+            return current
+
+        band_files = self.band_files(product_id)
+        needed = required_bands([index], cloud_mask)
+        missing = [band for band in needed if band not in band_files]
+        if missing:
+            raise FileNotFoundError(f"Bands {missing} of product {product_id} are not available")
+
+        job = {'id': job_id, 'status': 'queued', 'product_id': product_id, 'index': index,
+               'cloud_mask': bool(cloud_mask), 'geometry': mapping(geometry), 'submitted': time.time()}
+        os.makedirs(self.cache_folder, exist_ok=True)
+        if current is None:
+            # Claim the job, another request (in this or another process) may be queuing it too
+            try:
+                os.close(os.open(self._job_path(job_id), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                return self._read_job(job_id) or dict(job)
+        # New, failed before or abandoned by a dead process: (re)start it here
+        self._write_job(job)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='ondemand')
+            self._executor.submit(self._run, dict(job), geometry, {band: band_files[band] for band in needed})
+        return job
+
+    def get(self, job_id):
+        """
+        Return a job by id, None if it is unknown.
+        """
+        with self._lock:
+            result = self._find_result(job_id)
+        if result is not None:
+            return self._job(result, 'done')
+        return self._read_job(job_id)
+
+    def _job(self, result, status):
+        job = {key: value for key, value in result.items() if key != 'shape'}
+        job['status'] = status
+        return job
+
+    def _covering_result(self, job, geometry):
+        # A cached result of the same product and index whose polygon contains this one
+        with self._lock:
+            for result in self._load_results().values():
+                if (result['product_id'] == job['product_id'] and result['index'] == job['index']
+                        and result['cloud_mask'] == job['cloud_mask'] and result['shape'].covers(geometry)):
+                    return result
+        return None
+
+    def _run(self, job, geometry, band_paths):
+        job['status'] = 'running'
+        self._write_job(job)
+        result = {key: value for key, value in job.items() if key not in ('status', 'updated')}
+        scratch = os.path.join(self.cache_folder, f"{job['id']}.tmp")
+        try:
+            os.makedirs(scratch, exist_ok=True)
+            shapes = gp.GeoDataFrame({'field_id': [job['id']]}, geometry=[geometry], crs='EPSG:4326')
+            covering = self._covering_result(job, geometry)
+            output = os.path.join(scratch, 'index.tif')
+            if covering is not None:
+                # Cut out of the cached raster, the source bands are not read at all
+                source = self.raster_path(covering['id'])
+                with rasterio.open(source) as src:
+                    clip_raster(source, None, output, shapes=shapes.to_crs(src.crs))
+                result['source'] = covering['id']
+            else:
+                stack = BandStack(band_paths, shapes)
+                outputs = process_indices(scratch, [job['index']], workers=1, indices_folder=scratch,
+                                          cloud_mask=job['cloud_mask'], stack=stack)
+                os.replace(outputs[job['index']], output)
+                result['source'] = 'bands'
+
+            stats = zonal_stats({job['index']: output}, shapes)
+            row = stats.drop(columns=['field_id', 'index_name']).iloc[0].to_dict() if len(stats) else {}
+            result['stats'] = {key: _json_value(value) for key, value in row.items()}
+            with rasterio.open(output) as src:
+                result['bounds'] = list(transform_bounds(src.crs, 'EPSG:4326', *src.bounds))
+            result['finished'] = time.time()
+
+            # The raster first, a result is only listed once both files are in place
+            os.replace(output, self.raster_path(job['id']))
+            tmp = os.path.join(scratch, 'result.json')
+            with open(tmp, 'w') as f:
+                json.dump(result, f)
+            os.replace(tmp, self._result_path(job['id']))
+            with self._lock:
+                self._results[job['id']] = dict(result, shape=geometry)
+            os.remove(self._job_path(job['id']))
+        except Exception as error:
+            job['status'] = 'failed'
+            job['error'] = str(error)
+            self._write_job(job)
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,266 @@
+# importing libaraies
+import hashlib
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from glob import glob
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.io import MemoryFile
+from rasterio.transform import from_bounds
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+
+TILE_SIZE = 256
+# Seconds a listing of the index rasters is reused before the folder is listed again
+LISTING_TTL = 5
+# Rendered tiles written to the disk cache between two prunings of the cache
+PRUNE_EVERY = 256
+# Half the width of the Web Mercator world, in metres
+WORLD_HALF = 20037508.342789244
+
+# Value range mapped onto the colour ramp for each index
+INDEX_RANGES = {
+    'ndvi': (-0.2, 0.9),
+    'gci': (0.0, 8.0),
+    'evi': (-0.2, 1.0),
+    'savi': (-0.2, 0.9),
+    'ndwi': (-0.8, 0.6),
+    'ndre': (-0.2, 0.7),
+}
+
+# Red-yellow-green colour ramp, as (position, (red, green, blue)) stops
+COLOR_RAMP = [
+    (0.0, (165, 0, 38)),
+    (0.25, (244, 109, 67)),
+    (0.5, (255, 255, 191)),
+    (0.75, (102, 189, 99)),
+    (1.0, (0, 104, 55)),
+]
+
+
+def _color_table(ramp=COLOR_RAMP, size=256):
+    positions = np.linspace(0, 1, size)
+    stops = [position for position, _ in ramp]
+    return np.stack([np.interp(positions, stops, [color[band] for _, color in ramp]) for band in range(3)]).astype(np.uint8)
+
+COLOR_TABLE = _color_table()
+
+
+def tile_bounds(z, x, y):
+    """
+    Return the Web Mercator (EPSG:3857) bounds of an XYZ tile as (left, bottom, right, top).
+    """
+    size = 2 * WORLD_HALF / 2 ** z
+    left = -WORLD_HALF + x * size
+    top = WORLD_HALF - y * size
+    return left, top - size, left + size, top
+
+
+def colorize(values, index):
+    """
+    Map index values onto the colour ramp.
+
+    Args:
+        values (numpy.ndarray): Index values, NaN where there is no data.
+        index (str): Index name, key of INDEX_RANGES.
+
+    Returns:
+        numpy.ndarray: RGBA image of shape (4, rows, cols), transparent where there is no data.
+    """
+    low, high = INDEX_RANGES[index]
+    valid = np.isfinite(values)
+    scaled = np.clip((np.where(valid, values, low) - low) / (high - low), 0, 1)
+    rgba = np.zeros((4,) + values.shape, dtype=np.uint8)
+    rgba[:3] = COLOR_TABLE[:, (scaled * 255).astype(np.uint8)]
+    rgba[3] = np.where(valid, 255, 0)
+    return rgba
+
+
+def encode_png(rgba):
+    with rasterio.Env(GDAL_PAM_ENABLED='NO'):
+        with MemoryFile() as memfile:
+            with memfile.open(driver='PNG', width=rgba.shape[2], height=rgba.shape[1], count=4, dtype='uint8') as dst:
+                dst.write(rgba)
+            return memfile.read()
+
+
+def overview_level(src, z, y):
+    """
+    Return the overview level of a raster to read a tile of zoom z and row y from, None for the
+    full resolution: the coarsest overview still at least as fine as the pixels of the tile.
+    """
+    # Ground size of a tile pixel; Web Mercator stretches distances by 1 / cos(latitude)
+    size = 2 * WORLD_HALF / 2 ** z
+    latitude = math.atan(math.sinh(math.pi * (1 - 2 * (y + 0.5) / 2 ** z)))
+    pixel = size / TILE_SIZE * math.cos(latitude)
+    if src.crs and src.crs.is_geographic:
+        pixel /= 111320.0
+    level = None
+    for number, factor in enumerate(src.overviews(1)):
+        if src.res[0] * factor <= pixel:
+            level = number
+    return level
+
+
+def read_tile(path, z, x, y):
+    """
+    Read the part of a raster under an XYZ tile, reprojected to Web Mercator.
+
+    The raster is opened at the overview level matching the zoom (see overview_level) and read
+    through a warped VRT with the exact grid of the tile, so GDAL only decodes the blocks of that
+    overview under the tile; low zooms never touch the full resolution blocks.
+
+    Returns:
+        numpy.ndarray: float32 array of TILE_SIZE x TILE_SIZE, NaN where the raster has no data.
+    """
+    left, bottom, right, top = tile_bounds(z, x, y)
+    transform = from_bounds(left, bottom, right, top, TILE_SIZE, TILE_SIZE)
+    with rasterio.open(path) as src:
+        level = overview_level(src, z, y)
+        scale, offset = src.scales[0], src.offsets[0]
+    options = {'overview_level': level} if level is not None else {}
+    with rasterio.open(path, **options) as src:
+        with WarpedVRT(src, crs='EPSG:3857', transform=transform, width=TILE_SIZE, height=TILE_SIZE,
+                       resampling=Resampling.bilinear, src_nodata=src.nodata, nodata=np.nan,
+                       dtype='float32') as vrt:
+            values = vrt.read(1, masked=True).filled(np.nan)
+    # Scaled integer rasters store the index as value * scale + offset
+    if scale != 1 or offset != 0:
+        values = values * scale + offset
+    return values
+
+
+class TileRenderer:
+    """
+    Renders and caches PNG map tiles of the index rasters of a folder.
+
+    Every raster named *_<index>.tif in the folder (and its subfolders) is drawn, newest on top.
+    Rendered tiles are kept in an in-memory LRU cache bounded in bytes and in a disk cache; both are
+    keyed by the rasters drawn and their modification times, so recomputed rasters get new tiles.
+    The listing of the rasters is reused for LISTING_TTL seconds, and the disk cache is pruned
+    to disk_bytes, least recently used tiles first.
+    """
+
+    def __init__(self, indices_folder, cache_folder=None, memory_bytes=64 * 1024 * 1024,
+                 disk_bytes=1024 * 1024 * 1024):
+        self.indices_folder = indices_folder
+        self.cache_folder = cache_folder
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._tiles = OrderedDict()
+        self._size = 0
+        self._bounds = {}
+        self._listings = {}
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def rasters(self, index):
+        # (path, mtime, Web Mercator bounds) of the rasters of an index, newest first
+        with self._lock:
+            listing = self._listings.get(index)
+        if listing is not None and time.monotonic() - listing[0] < LISTING_TTL:
+            return listing[1]
+
+        paths = glob(os.path.join(self.indices_folder, '**', f'*_{index}.tif'), recursive=True)
+        rasters = []
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+            except FileNotFoundError:
+                continue
+            key = (path, mtime)
+            bounds = self._bounds.get(key)
+            if bounds is None:
+                with rasterio.open(path) as src:
+                    bounds = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+            rasters.append((path, mtime, bounds))
+        rasters.sort(key=lambda raster: raster[1], reverse=True)
+
+        with self._lock:
+            self._listings[index] = (time.monotonic(), rasters)
+            # Only the bounds of the rasters still listed are kept
+            self._bounds = {(path, mtime): bounds for listed in self._listings.values()
+                            for path, mtime, bounds in listed[1]}
+        return rasters
+
+    def prune_disk(self):
+        """
+        Delete the least recently used tiles of the disk cache until it fits in disk_bytes.
+        """
+        tiles = []
+        for folder, _, names in os.walk(self.cache_folder):
+            for name in names:
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                tiles.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in tiles)
+        for _, size, path in sorted(tiles):
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def tile(self, index, z, x, y):
+        """
+        Return the PNG bytes of a tile of an index, rendering it only when it is not cached.
+        """
+        left, bottom, right, top = tile_bounds(z, x, y)
+        rasters = [(path, mtime) for path, mtime, (b_left, b_bottom, b_right, b_top) in self.rasters(index)
+                   if b_left < right and b_right > left and b_bottom < top and b_top > bottom]
+        key = hashlib.sha1(repr((index, z, x, y, rasters)).encode()).hexdigest()
+
+        with self._lock:
+            png = self._tiles.get(key)
+            if png is not None:
+                self._tiles.move_to_end(key)
+                return png
+
+        disk_path = os.path.join(self.cache_folder, index, str(z), str(x), f'{y}_{key[:12]}.png') if self.cache_folder else None
+        if disk_path and os.path.exists(disk_path):
+            with open(disk_path, 'rb') as f:
+                png = f.read()
+            # The modification time of a disk tile is its last use, for the pruning
+            os.utime(disk_path)
+        else:
+            png = self.render(index, z, x, y, [path for path, _ in rasters])
+            if disk_path:
+                os.makedirs(os.path.dirname(disk_path), exist_ok=True)
+                tmp = f'{disk_path}.{threading.get_ident()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(png)
+                os.replace(tmp, disk_path)
+                with self._lock:
+                    self._written += 1
+                    prune = self._written % PRUNE_EVERY == 0
+                if prune:
+                    self.prune_disk()
+
+        with self._lock:
+            if key not in self._tiles:
+                self._tiles[key] = png
+                self._size += len(png)
+            while self._size > self.memory_bytes and self._tiles:
+                _, evicted = self._tiles.popitem(last=False)
+                self._size -= len(evicted)
+        return png
+
+    def render(self, index, z, x, y, paths):
+        # Draw the rasters newest first, older ones only fill the pixels still empty
+        values = np.full((TILE_SIZE, TILE_SIZE), np.nan, dtype=np.float32)
+        for path in paths:
+            empty = ~np.isfinite(values)
+            if not empty.any():
+                break
+            values[empty] = read_tile(path, z, x, y)[empty]
+        return encode_png(colorize(values, index))
@@ -0,0 +1,406 @@
+"""
+Offline benchmarks of the processing pipeline, the database ingestion and the app, on synthetic data.
+
+A synthetic Sentinel-2 tile and AOIs are written to a scratch folder (see synthetic.py), then each
+case is run a few times and its median wall time is compared to the baselines stored in
+baselines.json. The run fails when a case is slower than its baseline by more than the threshold.
+Nothing is downloaded: the raster and app cases only need the Python dependencies of the project;
+the database cases run when a database URI is given, in a scratch schema of that database.
+
+Cases:
+    clip_all_bands, clip_aois       clipping of the bands to one AOI, and to every AOI in one pass
+    indices_whole                   NDVI, GCI and EVI on the whole bands at once (window_budget=None)
+    indices_windowed                the same, window by window in one process
+    indices_workers                 window by window on a process pool
+    indices_quantized               window by window, written as scaled int16
+    indices_cloud_mask              window by window, masked with the SCL band
+    indices_stack                   window by window from the source bands, clipped on the fly
+    db_image_meta, db_image_meta_update, db_field_stats
+                                    COPY upserts of synthetic rows (with --db-uri)
+    tiles_cold, tiles_warm          concurrent map tile requests to the app, without and with cache
+    api_images, api_footprints      concurrent requests to the database endpoints of the app (with
+                                    --app-db, against the database configured in App/app.py)
+
+Usage:
+    python benchmarks/pipeline_bench.py [--size 2048] [--repeat 3] [--db-uri postgresql://...]
+    python benchmarks/pipeline_bench.py --save-baselines     # after an intended change of performance
+    python benchmarks/pipeline_bench.py --ci                 # in CI: missing baselines fail the run
+
+Baselines only compare runs made with the same size and on similar machines; the machine of the
+baselines is stored with them.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'scripts'), os.path.join(ROOT, 'App')]
+
+import numpy as np
+import pandas as pd
+
+from instrument import stage
+from synthetic import make_aois, make_product
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+SCHEMA = 'bench_pipeline'
+
+# Slowdown over the baseline above which a case fails, as a fraction of the baseline
+DEFAULT_THRESHOLD = 0.25
+# Cases shorter than this are compared with this much slack, timer noise dominates them
+MIN_SLACK_SECONDS = 0.05
+
+INDEX_NAMES = ('ndvi', 'gci', 'evi')
+TILE_ZOOM = 13
+
+
+def measure(name, function, repeat, results):
+    """
+    Run a case several times and keep the median of its stage metrics.
+    """
+    records = []
+    for number in range(repeat):
+        with stage(name, repeat=number) as record:
+            extra = function(number)
+        records.append(dict(record, **(extra or {})))
+    result = {'seconds': statistics.median(record['wall_seconds'] for record in records)}
+    for key in ('cpu_seconds', 'bytes_read', 'bytes_written', 'pixels'):
+        values = [record[key] for record in records if record.get(key) is not None]
+        if values:
+            result[key] = statistics.median(values)
+    result['peak_rss_bytes'] = records[-1]['peak_rss_bytes']
+    for key in records[-1]:
+        if key.startswith('latency_') or key == 'requests_per_second':
+            result[key] = statistics.median(record[key] for record in records)
+    results[name] = result
+    print(f"  {name:<22} {result['seconds']:8.3f} s" + "".join(
+        f"  {key} {value:.4f}" for key, value in result.items() if key.startswith('latency_')))
+
+
+def raster_cases(work, product, aois, args, results):
+    from bandstack import BandStack
+    from clipping import clip_aois, clip_all_bands
+    from indices import process_indices
+
+    aoi = next(iter(aois.values()))
+    band_paths = list(product.values())
+    processed = os.path.join(work, 'processed')
+
+    def clip(number):
+        clip_all_bands(band_paths, aoi, processed)
+
+    def clip_many(number):
+        clip_aois(band_paths, list(aois.values()), os.path.join(work, 'aois', str(number)))
+
+    def indices(name, **options):
+        def run(number):
+            process_indices(work, INDEX_NAMES, processed_folder=processed,
+                            indices_folder=os.path.join(work, name, str(number)), **options)
+        return run
+
+    def stack(number):
+        process_indices(work, INDEX_NAMES, indices_folder=os.path.join(work, 'indices_stack', str(number)),
+                        workers=1, stack=BandStack(product, aoi))
+
+    measure('clip_all_bands', clip, args.repeat, results)
+    measure('clip_aois', clip_many, args.repeat, results)
+    measure('indices_whole', indices('indices_whole', window_budget=None, workers=1), args.repeat, results)
+    measure('indices_windowed', indices('indices_windowed', workers=1), args.repeat, results)
+    measure('indices_workers', indices('indices_workers', workers=args.workers), args.repeat, results)
+    measure('indices_quantized', indices('indices_quantized', workers=1, quantize=True), args.repeat, results)
+    measure('indices_cloud_mask', indices('indices_cloud_mask', workers=1, cloud_mask=True), args.repeat, results)
+    measure('indices_stack', stack, args.repeat, results)
+    # The tiles are served from the indices of the last windowed run
+    return os.path.join(work, 'indices_windowed', str(args.repeat - 1))
+
+
+def image_meta_rows(count, seed=0):
+    # Synthetic sa.image_meta rows, one-degree footprints over the Iberian peninsula
+    import uuid
+    rng = np.random.default_rng(seed)
+    x = rng.uniform(-10, 3, count)
+    y = rng.uniform(36, 43, count)
+    return pd.DataFrame({
+        'id': [str(uuid.UUID(int=int(value))) for value in rng.integers(0, 2 ** 63, count)],
+        'title': [f'S2_BENCH_{number}' for number in range(count)],
+        'footprint': [f'MULTIPOLYGON((({a} {b},{a + 1} {b},{a + 1} {b + 1},{a} {b + 1},{a} {b})))'
+                      for a, b in zip(x, y)],
+        'date': pd.Timestamp('2017-01-01') + pd.to_timedelta(rng.integers(0, 2200, count), unit='D'),
+        'cloud_cover_percentage': rng.uniform(0, 100, count),
+        'Identifier': [f'S2_BENCH_{number}' for number in range(count)],
+        'processing_level': 'Level-2A',
+        'product_type': 'S2MSI2A',
+        'Size': '800 MB',
+        'Illumination Azimuth Angle': 150.0,
+        'Illumination Zenith Angle': 40.0,
+        'quicklook_url': [f'https://example.invalid/{number}' for number in range(count)],
+    })
+
+
+def field_stats_rows(fields, seed=0):
+    # Synthetic pa.field_stats rows of one product, one row per field and index
+    rng = np.random.default_rng(seed)
+    count = fields * len(INDEX_NAMES)
+    values = np.sort(rng.uniform(-0.2, 0.9, (count, 7)), axis=1)
+    total = rng.integers(50, 5000, count)
+    valid = (total * rng.uniform(0.5, 1, count)).astype(int)
+    return pd.DataFrame({
+        'field_id': np.repeat([f'F{number}' for number in range(fields)], len(INDEX_NAMES)),
+        'product_id': '00000000-0000-0000-0000-000000000001',
+        'date': pd.Timestamp('2022-09-01T10:56:31'),
+        'index_name': np.tile(INDEX_NAMES, fields),
+        'mean': values[:, 3], 'std': rng.uniform(0, 0.2, count), 'min': values[:, 0], 'max': values[:, 6],
+        'median': values[:, 3], 'p10': values[:, 1], 'p25': values[:, 2], 'p75': values[:, 4], 'p90': values[:, 5],
+        'valid_pixels': valid, 'total_pixels': total, 'valid_fraction': valid / total,
+    })
+
+
+def db_cases(args, results):
+    from sqlalchemy import text
+    from db import get_engine, upsert_dataframe
+
+    engine = get_engine(args.db_uri)
+    with engine.begin() as connection:
+        connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+        connection.execute(text(f"CREATE SCHEMA {SCHEMA}"))
+        # INCLUDING ALL copies the keys and indexes of the migrations
+        connection.execute(text(f"CREATE TABLE {SCHEMA}.image_meta (LIKE sa.image_meta INCLUDING ALL)"))
+        connection.execute(text(f"CREATE TABLE {SCHEMA}.field_stats (LIKE pa.field_stats INCLUDING ALL)"))
+
+    images = image_meta_rows(args.rows)
+    stats = field_stats_rows(args.rows)
+
+    def truncate():
+        with engine.begin() as connection:
+            connection.execute(text(f"TRUNCATE {SCHEMA}.image_meta, {SCHEMA}.field_stats"))
+
+    def insert_images(number):
+        truncate()
+        upsert_dataframe(images, 'image_meta', args.db_uri, schema=SCHEMA)
+
+    def update_images(number):
+        # The rows are already there: every row goes through ON CONFLICT DO UPDATE
+        upsert_dataframe(images, 'image_meta', args.db_uri, schema=SCHEMA)
+
+    def insert_stats(number):
+        truncate()
+        upsert_dataframe(stats, 'field_stats', args.db_uri, schema=SCHEMA,
+                         key=('field_id', 'product_id', 'index_name'), geometry_columns=())
+
+    try:
+        measure('db_image_meta', insert_images, args.repeat, results)
+        measure('db_image_meta_update', update_images, args.repeat, results)
+        measure('db_field_stats', insert_stats, args.repeat, results)
+    finally:
+        if not args.keep:
+            with engine.begin() as connection:
+                connection.execute(text(f"DROP SCHEMA IF EXISTS {SCHEMA} CASCADE"))
+
+
+def covering_tiles(folder, zoom, limit):
+    # XYZ tiles covering the index rasters of a folder, at most limit of them from the center out
+    import rasterio
+    from rasterio.warp import transform_bounds
+    from tiles import WORLD_HALF
+
+    left, bottom, right, top = math.inf, math.inf, -math.inf, -math.inf
+    for name in os.listdir(folder):
+        with rasterio.open(os.path.join(folder, name)) as src:
+            bounds = transform_bounds(src.crs, 'EPSG:3857', *src.bounds)
+        left, bottom = min(left, bounds[0]), min(bottom, bounds[1])
+        right, top = max(right, bounds[2]), max(top, bounds[3])
+    size = 2 * WORLD_HALF / 2 ** zoom
+    xs = range(int((left + WORLD_HALF) // size), int((right + WORLD_HALF) // size) + 1)
+    ys = range(int((WORLD_HALF - top) // size), int((WORLD_HALF - bottom) // size) + 1)
+    center = (statistics.mean(xs), statistics.mean(ys))
+    tiles = sorted(((x, y) for x in xs for y in ys), key=lambda tile: (tile[0] - center[0]) ** 2 + (tile[1] - center[1]) ** 2)
+    return tiles[:limit]
+
+
+def load(base_url, paths, requests, concurrency):
+    """
+    Request paths in a loop from concurrent clients and return the latency percentiles.
+    """
+    def fetch(number):
+        started = time.perf_counter()
+        with urllib.request.urlopen(base_url + paths[number % len(paths)]) as response:
+            response.read()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = sorted(executor.map(fetch, range(requests)))
+    elapsed = time.perf_counter() - started
+    return {'latency_p50': latencies[len(latencies) // 2],
+            'latency_p95': latencies[min(int(len(latencies) * 0.95), len(latencies) - 1)],
+            'requests_per_second': requests / elapsed}
+
+
+def app_cases(work, indices_folder, args, results):
+    from werkzeug.serving import make_server
+    import app as app_module
+    from tiles import TileRenderer
+
+    server = make_server('127.0.0.1', 0, app_module.app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f'http://127.0.0.1:{server.server_port}'
+    tiles = covering_tiles(indices_folder, TILE_ZOOM, args.tiles)
+    paths = [f'/tiles/{index}/{TILE_ZOOM}/{x}/{y}.png' for index in INDEX_NAMES for x, y in tiles]
+
+    def cold(number):
+        # Without cache every request renders its tile from the rasters
+        app_module.tile_renderer = TileRenderer(indices_folder, None, memory_bytes=0)
+        return load(base_url, paths, len(paths), args.concurrency)
+
+    def warm(number):
+        # Every tile is in the memory cache of the renderer
+        return load(base_url, paths, args.requests, args.concurrency)
+
+    try:
+        measure('tiles_cold', cold, args.repeat, results)
+        app_module.tile_renderer = TileRenderer(indices_folder, os.path.join(work, 'tile_cache'))
+        load(base_url, paths, len(paths), args.concurrency)
+        measure('tiles_warm', warm, args.repeat, results)
+        if args.app_db:
+            images = ['/api/images?bbox=-10,36,3,44&max_cloud=30', '/api/images?point=-3.7,40.4',
+                      '/api/images?start_date=2022-09-01&end_date=2022-11-30']
+            footprints = [f'/api/footprints?bbox=-10,36,3,44&zoom={zoom}' for zoom in range(4, 9)]
+            measure('api_images', lambda number: load(base_url, images, args.requests, args.concurrency),
+                    args.repeat, results)
+            measure('api_footprints', lambda number: load(base_url, footprints, args.requests, args.concurrency),
+                    args.repeat, results)
+    finally:
+        server.shutdown()
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'cpus': os.cpu_count(),
+            'processor': platform.processor() or platform.machine()}
+
+
+def compare(results, baselines, threshold):
+    """
+    Compare the results with the baselines.
+
+    Returns:
+        list: Descriptions of the cases slower than their baseline by more than the threshold.
+    """
+    regressions = []
+    print(f"\n  {'case':<22} {'baseline':>9} {'now':>9} {'change':>8}")
+    for name, result in results.items():
+        baseline = baselines['cases'].get(name)
+        if baseline is None:
+            print(f"  {name:<22} {'-':>9} {result['seconds']:9.3f}   no baseline")
+            continue
+        limit = baseline.get('threshold', threshold)
+        allowed = max(baseline['seconds'] * (1 + limit), baseline['seconds'] + MIN_SLACK_SECONDS)
+        change = result['seconds'] / baseline['seconds'] - 1 if baseline['seconds'] else 0.0
+        failed = result['seconds'] > allowed
+        print(f"  {name:<22} {baseline['seconds']:9.3f} {result['seconds']:9.3f} {change:+8.1%}"
+              + ("   REGRESSION" if failed else ""))
+        if failed:
+            regressions.append(f"{name} {change:+.1%} (threshold {limit:.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=2048, help='Rows and columns of the 10 m bands')
+    parser.add_argument('--aois', type=int, default=3, help='Number of synthetic AOIs')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each case, the median is kept')
+    parser.add_argument('--workers', type=int, default=None, help='Workers of indices_workers, defaults to the CPUs')
+    parser.add_argument('--db-uri', help='Database of the ingestion cases, e.g. a local Postgres with database/db.sql')
+    parser.add_argument('--rows', type=int, default=10000, help='Rows of the ingestion cases')
+    parser.add_argument('--app-db', action='store_true', help='Also load the database endpoints of the app')
+    parser.add_argument('--tiles', type=int, default=32, help='Tiles per index of the tile cases')
+    parser.add_argument('--requests', type=int, default=500, help='Requests of the load cases')
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients of the load cases')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Slowdown over the baseline failing a case, for the cases without their own')
+    parser.add_argument('--cases', nargs='+', choices=('raster', 'db', 'app'), default=('raster', 'db', 'app'))
+    parser.add_argument('--baselines', default=BASELINES)
+    parser.add_argument('--save-baselines', action='store_true', help='Store the results as the new baselines')
+    parser.add_argument('--ci', action='store_true',
+                        help='Fail when the baselines are missing, were measured with another configuration '
+                             'or lack a case, instead of only reporting it')
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    parser.add_argument('--keep', action='store_true', help='Keep the scratch folder and schema at the end')
+    args = parser.parse_args()
+
+    work = tempfile.mkdtemp(prefix='chm_bench_')
+    results = {}
+    try:
+        print(f"Synthetic data in {work}")
+        product = make_product(os.path.join(work, 'product'), args.size)
+        aois = make_aois(os.path.join(work, 'aois_src'), args.size, args.aois)
+
+        indices_folder = None
+        if 'raster' in args.cases or 'app' in args.cases:
+            print("\nRaster cases")
+            indices_folder = raster_cases(work, product, aois, args, results)
+        if 'db' in args.cases and args.db_uri:
+            print("\nDatabase cases")
+            db_cases(args, results)
+        if 'app' in args.cases:
+            print("\nApp cases")
+            app_cases(work, indices_folder, args, results)
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    config = {'size': args.size, 'aois': args.aois, 'rows': args.rows, 'tiles': args.tiles,
+              'requests': args.requests, 'concurrency': args.concurrency}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine(), 'config': config, 'cases': results}, f, indent=2)
+
+    if args.save_baselines:
+        baselines = {'machine': machine(), 'config': config, 'cases': {}}
+        if os.path.exists(args.baselines):
+            with open(args.baselines) as f:
+                previous = json.load(f)
+            if previous.get('config') == config:
+                baselines['cases'] = previous['cases']
+        for name, result in results.items():
+            threshold = baselines['cases'].get(name, {}).get('threshold', args.threshold)
+            baselines['cases'][name] = {'seconds': round(result['seconds'], 4), 'threshold': threshold}
+        with open(args.baselines, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nBaselines written to {args.baselines}")
+        return
+
+    # Without --ci a run with nothing to compare to only reports it; in CI it must not pass silently
+    exit_code = 1 if args.ci else 0
+    if not os.path.exists(args.baselines):
+        print(f"\nNo baselines in {args.baselines}, run with --save-baselines on the reference machine to create them")
+        sys.exit(exit_code)
+    with open(args.baselines) as f:
+        baselines = json.load(f)
+    if baselines.get('config') != config:
+        print(f"\nThe baselines were measured with {baselines.get('config')}, not compared")
+        sys.exit(exit_code)
+    if baselines.get('machine', {}).get('cpus') != os.cpu_count():
+        print(f"\nThe baselines were measured on {baselines.get('machine')}, the comparison is indicative")
+    regressions = compare(results, baselines, args.threshold)
+    missing = [name for name in results if name not in baselines['cases']]
+    if args.ci and missing:
+        regressions.append(f"no baseline for {', '.join(missing)}")
+    if regressions:
+        print("\nRegressions: " + "; ".join(regressions))
+        sys.exit(1)
+    print("\nNo regression")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+"""
+Synthetic Sentinel-2 L2A data for the offline benchmarks.
+
+make_product writes the bands of a fake tile the way they come in a SAFE product: one file per
+band named ..._<band>_<resolution>m.jp2 (GeoTIFF when GDAL has no JPEG 2000 driver), 10 m and
+20 m grids in a UTM zone, uint16 digital numbers with nodata 0 and a Scene Classification Layer
+with clouds and shadows. The values are smooth fields with noise, so they compress like real
+scenes. make_aois writes AOI GeoJSON files shaped like the ones of Files/Data_clip: skewed
+quadrilaterals and one seven-vertex polygon in the UTM CRS of the tile. Everything is seeded, so
+two runs with the same arguments write the same data.
+"""
+import os
+
+import numpy as np
+import rasterio
+from affine import Affine
+
+# UTM zone 30N, and the upper left corner of the fake tile (the MADRID AOI is in this tile)
+CRS = 'EPSG:32630'
+ORIGIN = (399960.0, 4500000.0)
+
+# Bands written at 20 m, the others at 10 m
+BANDS_20M = ('B05', 'B06', 'B07', 'B8A', 'B11', 'B12', 'SCL')
+DEFAULT_BANDS = ('B02', 'B03', 'B04', 'B08', 'SCL')
+
+# Mean digital numbers of the bands over vegetation
+BAND_LEVELS = {'B02': 600, 'B03': 900, 'B04': 800, 'B05': 1400, 'B06': 2400, 'B07': 2800, 'B08': 3200,
+               'B8A': 3300, 'B11': 2200, 'B12': 1400}
+
+# SCL classes written: bare soil, vegetation and water by vegetation level, then cloud shadow,
+# medium and high probability cloud
+SCL_CLEAR = (5, 4, 6)
+SCL_CLOUD = (3, 8, 9)
+
+
+def jp2_available():
+    """
+    Return whether GDAL can write JPEG 2000 files.
+    """
+    with rasterio.Env() as env:
+        return 'JP2OpenJPEG' in env.drivers()
+
+
+def _smooth_field(rng, height, width, cells=16):
+    # Bilinear upsampling of a coarse random grid, values in [0, 1]
+    coarse = rng.random((cells + 1, cells + 1))
+    rows = np.linspace(0, cells, height, dtype=np.float32)
+    cols = np.linspace(0, cells, width, dtype=np.float32)
+    r0 = np.minimum(rows.astype(int), cells - 1)
+    c0 = np.minimum(cols.astype(int), cells - 1)
+    fr = (rows - r0)[:, None]
+    fc = (cols - c0)[None, :]
+    top = coarse[r0][:, c0] * (1 - fc) + coarse[r0][:, c0 + 1] * fc
+    bottom = coarse[r0 + 1][:, c0] * (1 - fc) + coarse[r0 + 1][:, c0 + 1] * fc
+    return (top * (1 - fr) + bottom * fr).astype(np.float32)
+
+
+def make_product(folder, size=2048, bands=DEFAULT_BANDS, cloud_fraction=0.2, nodata_fraction=0.05, seed=0,
+                 driver=None):
+    """
+    Write the bands of a synthetic Sentinel-2 L2A tile.
+
+    Args:
+        folder (str): Output folder, created if needed.
+        size (int): Rows and columns of the 10 m bands; 20 m bands have half of them.
+        bands (Iterable[str]): Bands to write.
+        cloud_fraction (float): Approximate fraction of cloud and shadow pixels in the SCL band.
+        nodata_fraction (float): Fraction of columns on the east edge without data, as in the
+            tiles on the edge of a swath.
+        seed (int): Seed of the random generator.
+        driver (str): 'JP2OpenJPEG' or 'GTiff', defaults to JPEG 2000 when available.
+
+    Returns:
+        dict: Band name -> path of the band file.
+    """
+    os.makedirs(folder, exist_ok=True)
+    driver = driver or ('JP2OpenJPEG' if jp2_available() else 'GTiff')
+    extension = 'jp2' if driver == 'JP2OpenJPEG' else 'tif'
+    rng = np.random.default_rng(seed)
+    vegetation = _smooth_field(rng, size, size)
+    clouds = _smooth_field(rng, size, size, cells=8)
+    cloudy = clouds > np.quantile(clouds, 1 - cloud_fraction)
+    nodata = np.zeros((size, size), dtype=bool)
+    nodata[:, size - int(size * nodata_fraction):] = True
+
+    paths = {}
+    for band in bands:
+        resolution = 20 if band in BANDS_20M else 10
+        step = resolution // 10
+        if band == 'SCL':
+            data = np.asarray(SCL_CLEAR, dtype=np.uint8)[np.digitize(vegetation, (0.3, 0.9))]
+            # Shadows on the thin edges of the clouds, then medium and high probability cloud
+            cloud_values = clouds[cloudy]
+            if cloud_values.size:
+                edges = np.quantile(cloud_values, (1 / 3, 2 / 3))
+                data[cloudy] = np.asarray(SCL_CLOUD, dtype=np.uint8)[np.digitize(cloud_values, edges)]
+            data[nodata] = 0
+        else:
+            # Red and blue drop over vegetation, near infrared rises; clouds are bright everywhere
+            level = BAND_LEVELS[band]
+            trend = vegetation if band in ('B06', 'B07', 'B08', 'B8A') else 1 - vegetation
+            values = level * (0.5 + trend) + rng.normal(0, level * 0.03, (size, size))
+            values[cloudy] = 6000 + 2000 * clouds[cloudy]
+            data = np.clip(values, 1, 65535).astype(np.uint16)
+            data[nodata] = 0
+        data = data[::step, ::step]
+
+        path = os.path.join(folder, f'T30TVK_20220901T105631_{band}_{resolution}m.{extension}')
+        profile = dict(driver=driver, height=data.shape[0], width=data.shape[1], count=1, dtype=data.dtype,
+                       crs=CRS, transform=Affine(resolution, 0, ORIGIN[0], 0, -resolution, ORIGIN[1]), nodata=0)
+        if driver == 'GTiff':
+            profile.update(tiled=True, blockxsize=512, blockysize=512, compress='DEFLATE')
+        with rasterio.open(path, 'w', **profile) as dst:
+            dst.write(data, 1)
+        paths[band] = path
+    return paths
+
+
+def make_aois(folder, size=2048, count=3, seed=0):
+    """
+    Write AOI GeoJSON files inside the footprint of a synthetic tile.
+
+    Args:
+        folder (str): Output folder, created if needed.
+        size (int): Size of the tile in 10 m pixels, as given to make_product.
+        count (int): Number of AOIs; the last one is a seven-vertex polygon, the others skewed
+            quadrilaterals like the AOIs of Files/Data_clip.
+        seed (int): Seed of the random generator.
+
+    Returns:
+        dict: AOI name -> path of the GeoJSON file.
+    """
+    import geopandas as gp
+    from shapely.geometry import MultiPolygon, Polygon
+
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    extent = size * 10.0
+    paths = {}
+    for number in range(count):
+        # Between a tenth and a half of the tile wide, fully inside it
+        half = extent * rng.uniform(0.05, 0.25)
+        cx = ORIGIN[0] + rng.uniform(1.1 * half, extent - 1.1 * half)
+        cy = ORIGIN[1] - rng.uniform(1.1 * half, extent - 1.1 * half)
+        if number == count - 1:
+            angles = np.sort(rng.uniform(0, 2 * np.pi, 7))
+            radii = half * rng.uniform(0.6, 1.0, 7)
+            ring = [(cx + r * np.cos(a), cy + r * np.sin(a)) for a, r in zip(angles, radii)]
+        else:
+            jitter = half * 0.05
+            ring = [(cx + dx * half + rng.uniform(-jitter, jitter), cy + dy * half + rng.uniform(-jitter, jitter))
+                    for dx, dy in ((-1, 1), (1, 1), (1, -1), (-1, -1))]
+        name = f'AOI{number + 1}_UTM_Z30N'
+        path = os.path.join(folder, f'{name}.geojson')
+        shapes = gp.GeoDataFrame({'id': [None]}, geometry=[MultiPolygon([Polygon(ring)])], crs=CRS)
+        if os.path.exists(path):
+            os.remove(path)
+        shapes.to_file(path, driver='GeoJSON')
+        paths[name] = path
+    return paths
@@ -0,0 +1,18 @@
+-- Version of each table, bumped on every change so the app can invalidate its cached responses
+CREATE TABLE IF NOT EXISTS sa.table_versions(
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP NOT NULL DEFAULT now());
+
+CREATE OR REPLACE FUNCTION sa.bump_table_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO sa.table_versions (table_name, version, updated_at) VALUES (TG_TABLE_NAME, 1, now())
+    ON CONFLICT (table_name) DO UPDATE SET version = sa.table_versions.version + 1, updated_at = now();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS image_meta_version ON sa.image_meta;
+CREATE TRIGGER image_meta_version
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sa.image_meta
+    FOR EACH STATEMENT EXECUTE FUNCTION sa.bump_table_version();
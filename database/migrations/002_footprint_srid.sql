@@ -0,0 +1,3 @@
+-- Footprints are WGS84, declare it so spatial filters and indexes compare geometries of one SRID
+ALTER TABLE sa.image_meta
+    ALTER COLUMN footprint TYPE GEOMETRY(POLYGON, 4326) USING ST_SetSRID(footprint, 4326);
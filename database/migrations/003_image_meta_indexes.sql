@@ -0,0 +1,11 @@
+-- Spatial index for the footprint intersection filters of /api/footprints and /api/images
+CREATE INDEX IF NOT EXISTS image_meta_footprint_gist ON sa.image_meta USING GIST (footprint);
+
+-- Date index in the (date, id) order of the keyset pagination; the cloud cover is included so
+-- date and cloud filters are answered by index-only scans
+CREATE INDEX IF NOT EXISTS image_meta_date_id ON sa.image_meta (date, id) INCLUDE (cloud_cover_percentage);
+
+-- Cloud cover index for the queries filtering mostly on cloud cover
+CREATE INDEX IF NOT EXISTS image_meta_cloud_date ON sa.image_meta (cloud_cover_percentage, date);
+
+ANALYZE sa.image_meta;
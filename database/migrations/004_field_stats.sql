@@ -0,0 +1,24 @@
+-- Per-field statistics of the vegetation indices, one row per field, product and index
+CREATE SCHEMA IF NOT EXISTS pa;
+
+CREATE TABLE IF NOT EXISTS pa.field_stats(
+    field_id TEXT NOT NULL,
+    product_id UUID NOT NULL,
+    date TIMESTAMP NOT NULL,
+    index_name TEXT NOT NULL,
+    mean FLOAT,
+    std FLOAT,
+    min FLOAT,
+    max FLOAT,
+    median FLOAT,
+    p10 FLOAT,
+    p25 FLOAT,
+    p75 FLOAT,
+    p90 FLOAT,
+    valid_pixels INTEGER NOT NULL,
+    total_pixels INTEGER NOT NULL,
+    valid_fraction FLOAT NOT NULL,
+    PRIMARY KEY (field_id, product_id, index_name));
+
+-- Time series of a field for an index
+CREATE INDEX IF NOT EXISTS field_stats_field_index_date ON pa.field_stats (field_id, index_name, date);
@@ -0,0 +1,20 @@
+-- Performance metrics of the pipeline stages, one row per stage of a run (scripts/instrument.py)
+CREATE SCHEMA IF NOT EXISTS pa;
+
+CREATE TABLE IF NOT EXISTS pa.pipeline_runs(
+    run_id UUID NOT NULL,
+    seq INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    labels JSONB,
+    status TEXT NOT NULL,
+    started_at TIMESTAMP NOT NULL,
+    wall_seconds FLOAT NOT NULL,
+    cpu_seconds FLOAT NOT NULL,
+    bytes_read BIGINT,
+    bytes_written BIGINT,
+    pixels BIGINT NOT NULL,
+    peak_rss_bytes BIGINT,
+    PRIMARY KEY (run_id, seq));
+
+-- Metrics of a stage over time
+CREATE INDEX IF NOT EXISTS pipeline_runs_stage_started ON pa.pipeline_runs (stage, started_at);
@@ -0,0 +1,119 @@
+import os
+
+import geopandas as gp
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.windows import Window, transform as window_transform
+from shapely.geometry import mapping
+
+from clipping import plan_clip
+from raster_io import read_on_grid
+from windowed import _open
+
+
+class WindowSource:
+    """
+    Lazy view of a band file clipped to an AOI, on the grid of the band stack.
+
+    Reading a window decodes only the matching part of the source file, resamples it when the
+    band has another resolution than the grid, and sets the pixels outside the AOI to nodata,
+    which gives the same pixels as reading the band clipped by clip_raster. Instances only hold
+    the path, the grid and the AOI geometries, so they can be sent to worker processes.
+
+    Args:
+        path (str): Path of the source band, e.g. a .jp2 of the SAFE product.
+        crs: CRS of the grid.
+        transform (Affine): Transform of the grid.
+        width (int): Number of columns of the grid.
+        height (int): Number of rows of the grid.
+        geometries (list): AOI geometries as GeoJSON-like dicts, in the CRS of the grid, None to
+            read the band without clipping it.
+        nodata (float): Value of the pixels outside the AOI.
+        resampling (Resampling): Resampling of bands at another resolution than the grid.
+        block_shape (tuple): (rows, cols) to align the processing windows on.
+    """
+
+    def __init__(self, path, crs, transform, width, height, geometries, nodata=0,
+                 resampling=Resampling.bilinear, block_shape=(1, 1)):
+        self.path = path
+        self.crs = crs
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.geometries = geometries
+        self.nodata = nodata
+        self.resampling = resampling
+        self.block_shape = block_shape
+
+    def read(self, window):
+        shape = (int(window.height), int(window.width))
+        data = read_on_grid(_open(self.path), window, self.transform, self.resampling, self.nodata)
+        if self.geometries is not None:
+            outside = geometry_mask(self.geometries, out_shape=shape,
+                                    transform=window_transform(window, self.transform))
+            data[outside] = self.nodata
+        return data
+
+
+class BandStack:
+    """
+    Bands of a product clipped to an AOI and aligned on one grid, without writing any file.
+
+    The grid is the clip window of the AOI on the finest band. Each band is exposed as a
+    WindowSource that the windowed engine reads window by window straight from the source file;
+    20 m bands (red edge, SWIR, SCL) are resampled to the 10 m grid on the fly.
+
+    Args:
+        band_paths (dict): Band name -> path of the source band file.
+        shapes (geopandas.GeoDataFrame or str): The AOI geometries, or the path of a vector file.
+        resampling (Resampling): Resampling of the bands coarser than the grid.
+    """
+
+    def __init__(self, band_paths, shapes, resampling=Resampling.bilinear):
+        if isinstance(shapes, str):
+            shapes = gp.read_file(shapes)
+        self.band_paths = dict(band_paths)
+
+        # The grid is the one of the finest band
+        resolutions = {}
+        for band, path in self.band_paths.items():
+            with rasterio.open(path) as src:
+                resolutions[band] = src.res[0]
+        reference = min(resolutions, key=resolutions.get)
+        with rasterio.open(self.band_paths[reference]) as src:
+            if src.crs and shapes.crs and shapes.crs != src.crs:
+                shapes = shapes.to_crs(src.crs)
+            plan = plan_clip(src, shapes)
+            self.crs = src.crs
+            self.block_shape = src.block_shapes[0]
+        self.transform = plan.transform
+        self.height, self.width = plan.mask.shape
+        geometries = [mapping(geometry) for geometry in shapes.geometry]
+
+        self.sources = {}
+        for band, path in self.band_paths.items():
+            with rasterio.open(path) as src:
+                nodata = src.nodata if src.nodata is not None else 0
+            # Classes must not be interpolated
+            band_resampling = Resampling.nearest if band == 'SCL' else resampling
+            self.sources[band] = WindowSource(path, self.crs, self.transform, self.width, self.height, geometries,
+                                              nodata, band_resampling, self.block_shape)
+
+    def __getitem__(self, band):
+        return self.sources[band]
+
+    def __contains__(self, band):
+        return band in self.sources
+
+    def read(self, band, window=None):
+        """
+        Read a window of a band, the whole clipped band by default.
+        """
+        return self.sources[band].read(window or Window(0, 0, self.width, self.height))
+
+    def file_stem(self, band):
+        """
+        Return the name of the source file of a band, without extension.
+        """
+        return os.path.splitext(os.path.basename(self.band_paths[band]))[0]
@@ -0,0 +1,250 @@
+import json
+import sqlite3
+import threading
+from datetime import date, datetime, time
+
+import geopandas as gp
+from shapely import wkt
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS products (
+    id INTEGER PRIMARY KEY,
+    uuid TEXT NOT NULL UNIQUE,
+    title TEXT,
+    date TEXT NOT NULL,
+    cloud REAL,
+    footprint TEXT NOT NULL,
+    properties TEXT NOT NULL,
+    odata TEXT,
+    band_files TEXT
+);
+CREATE INDEX IF NOT EXISTS products_date ON products (date, cloud);
+CREATE VIRTUAL TABLE IF NOT EXISTS products_rtree USING rtree (id, minx, maxx, miny, maxy);
+CREATE TABLE IF NOT EXISTS searches (
+    id INTEGER PRIMARY KEY,
+    footprint TEXT NOT NULL,
+    start TEXT NOT NULL,
+    "end" TEXT NOT NULL,
+    cloud_min REAL NOT NULL,
+    cloud_max REAL NOT NULL,
+    platform TEXT NOT NULL,
+    level TEXT NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS searches_rtree USING rtree (id, minx, maxx, miny, maxy);
+"""
+
+
+def parse_date(value):
+    """
+    Convert a query date to a datetime.
+
+    Args:
+        value (str, date or datetime): 'YYYYMMDD', 'YYYY-MM-DD', an ISO timestamp, 'NOW' or a date.
+
+    Returns:
+        datetime: The date at midnight for plain dates, like sentinelsat does.
+    """
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, date):
+        return datetime.combine(value, time())
+    if value.upper() == 'NOW':
+        return datetime.utcnow()
+    for fmt in ('%Y%m%d', '%Y-%m-%d'):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    return datetime.fromisoformat(value.rstrip('Z')).replace(tzinfo=None)
+
+
+def _encode(value):
+    # JSON encoder keeping datetimes as datetimes on the way back
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    return str(value)
+
+
+def _decode(obj):
+    if '__datetime__' in obj:
+        return datetime.fromisoformat(obj['__datetime__'])
+    return obj
+
+
+def _subtract(start, end, intervals):
+    # Parts of [start, end] not covered by the intervals
+    gaps = []
+    cursor = start
+    for interval_start, interval_end in sorted(intervals):
+        if interval_end < cursor:
+            continue
+        if interval_start > end:
+            break
+        if interval_start > cursor:
+            gaps.append((cursor, interval_start))
+        cursor = max(cursor, interval_end)
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+class Catalog:
+    """
+    Persistent local catalog of Sentinel-2 product metadata, stored in SQLite.
+
+    Products are indexed by footprint (R*Tree over their bounding boxes) and by date. Every remote
+    query is recorded with its footprint, dates and cloud range, so a later search over the same or
+    a smaller area is answered locally and only the date ranges never queried before go to the hub.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def search(self, api, footprint, date_range, cloudcoverpercentage=(0, 100),
+               platformname='Sentinel-2', processinglevel='Level-2A'):
+        """
+        Search products, querying the hub only for the dates not yet covered by the catalog.
+
+        Args:
+            api (sentinelsat.SentinelAPI): Instance of the Copernicus hub API, used for the missing dates.
+            footprint (str): WKT of the area of interest, in WGS84.
+            date_range (tuple): Start and end date, e.g. ('20220901', '20221130').
+            cloudcoverpercentage (tuple): Minimum and maximum cloud cover percentage.
+            platformname (str): Platform name of the products.
+            processinglevel (str): Processing level of the products.
+
+        Returns:
+            geopandas.GeoDataFrame: The matching products, with the columns of SentinelAPI.to_geodataframe.
+        """
+        start, end = parse_date(date_range[0]), parse_date(date_range[1])
+        cloud_min, cloud_max = cloudcoverpercentage
+        geometry = wkt.loads(footprint)
+
+        for gap_start, gap_end in self._missing_dates(geometry, start, end, cloud_min, cloud_max,
+                                                      platformname, processinglevel):
+            products = api.query(footprint, date=(gap_start, gap_end), platformname=platformname,
+                                 processinglevel=processinglevel, cloudcoverpercentage=cloudcoverpercentage)
+            self.add_products(products)
+            self._record_search(geometry, gap_start, gap_end, cloud_min, cloud_max, platformname, processinglevel)
+
+        return self.find(geometry, start, end, cloud_min, cloud_max)
+
+    def find(self, geometry, start, end, cloud_min=0, cloud_max=100):
+        """
+        Find catalogued products intersecting a geometry within dates and cloud cover, without any remote query.
+
+        Returns:
+            geopandas.GeoDataFrame: The matching products.
+        """
+        if isinstance(geometry, str):
+            geometry = wkt.loads(geometry)
+        minx, miny, maxx, maxy = geometry.bounds
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT p.properties FROM products_rtree r JOIN products p ON p.id = r.id
+                   WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?
+                     AND p.date BETWEEN ? AND ? AND p.cloud BETWEEN ? AND ?""",
+                (maxx, minx, maxy, miny, parse_date(start).isoformat(), parse_date(end).isoformat(),
+                 cloud_min, cloud_max)).fetchall()
+
+        records = [json.loads(row[0], object_hook=_decode) for row in rows]
+        gdf = gp.GeoDataFrame(records, geometry=[wkt.loads(r['footprint']) for r in records], crs='EPSG:4326')
+        if gdf.empty:
+            return gdf
+        gdf = gdf[gdf.intersects(geometry)]
+        return gdf.set_index('uuid', drop=False)
+
+    def add_products(self, products):
+        """
+        Insert or update products returned by SentinelAPI.query (uuid -> properties).
+        """
+        with self._lock, self._conn:
+            for uuid, properties in products.items():
+                properties = dict(properties, uuid=uuid)
+                geometry = wkt.loads(properties['footprint'])
+                acquired = parse_date(properties.get('beginposition') or properties['ingestiondate'])
+                self._conn.execute(
+                    """INSERT INTO products (uuid, title, date, cloud, footprint, properties)
+                       VALUES (?, ?, ?, ?, ?, ?)
+                       ON CONFLICT (uuid) DO UPDATE SET title = excluded.title, date = excluded.date,
+                           cloud = excluded.cloud, footprint = excluded.footprint, properties = excluded.properties""",
+                    (uuid, properties.get('title'), acquired.isoformat(), properties.get('cloudcoverpercentage'),
+                     properties['footprint'], json.dumps(properties, default=_encode)))
+                row_id = self._conn.execute("SELECT id FROM products WHERE uuid = ?", (uuid,)).fetchone()[0]
+                minx, miny, maxx, maxy = geometry.bounds
+                self._conn.execute("INSERT OR REPLACE INTO products_rtree VALUES (?, ?, ?, ?, ?)",
+                                   (row_id, minx, maxx, miny, maxy))
+
+    def product_odata(self, api, uuid):
+        """
+        Return the full OData metadata of a product, fetched from the hub only the first time.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT odata FROM products WHERE uuid = ?", (uuid,)).fetchone()
+        if row and row[0]:
+            return json.loads(row[0], object_hook=_decode)
+
+        odata = api.get_product_odata(uuid, full=True)
+        with self._lock, self._conn:
+            if row is None:
+                # Product fetched directly by id, catalogue it from its OData metadata
+                self._conn.execute(
+                    "INSERT INTO products (uuid, title, date, cloud, footprint, properties) VALUES (?, ?, ?, ?, ?, ?)",
+                    (uuid, odata.get('title'), parse_date(odata['date']).isoformat(),
+                     odata.get('Cloud cover percentage'), odata['footprint'],
+                     json.dumps({'uuid': uuid, 'title': odata.get('title'), 'footprint': odata['footprint'],
+                                 'beginposition': odata['date'],
+                                 'cloudcoverpercentage': odata.get('Cloud cover percentage')}, default=_encode)))
+                row_id = self._conn.execute("SELECT id FROM products WHERE uuid = ?", (uuid,)).fetchone()[0]
+                minx, miny, maxx, maxy = wkt.loads(odata['footprint']).bounds
+                self._conn.execute("INSERT OR REPLACE INTO products_rtree VALUES (?, ?, ?, ?, ?)",
+                                   (row_id, minx, maxx, miny, maxy))
+            self._conn.execute("UPDATE products SET odata = ? WHERE uuid = ?",
+                               (json.dumps(odata, default=_encode), uuid))
+        return odata
+
+    def set_band_files(self, uuid, band_files):
+        """
+        Record the local band files of a product (band -> path).
+        """
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE products SET band_files = ? WHERE uuid = ?", (json.dumps(band_files), uuid))
+
+    def band_files(self, uuid):
+        """
+        Return the local band files of a product (band -> path), empty if none were recorded.
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT band_files FROM products WHERE uuid = ?", (uuid,)).fetchone()
+        return json.loads(row[0]) if row and row[0] else {}
+
+    def _missing_dates(self, geometry, start, end, cloud_min, cloud_max, platform, level):
+        # Previous searches over an area containing this one, with a cloud range containing this one
+        minx, miny, maxx, maxy = geometry.bounds
+        with self._lock:
+            rows = self._conn.execute(
+                """SELECT s.footprint, s.start, s."end" FROM searches_rtree r JOIN searches s ON s.id = r.id
+                   WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?
+                     AND s.cloud_min <= ? AND s.cloud_max >= ? AND s.platform = ? AND s.level = ?
+                     AND s.start <= ? AND s."end" >= ?""",
+                (minx, maxx, miny, maxy, cloud_min, cloud_max, platform, level,
+                 end.isoformat(), start.isoformat())).fetchall()
+        covered = [(datetime.fromisoformat(s), datetime.fromisoformat(e))
+                   for footprint, s, e in rows if wkt.loads(footprint).covers(geometry)]
+        return _subtract(start, end, covered)
+
+    def _record_search(self, geometry, start, end, cloud_min, cloud_max, platform, level):
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                """INSERT INTO searches (footprint, start, "end", cloud_min, cloud_max, platform, level)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (geometry.wkt, start.isoformat(), end.isoformat(), cloud_min, cloud_max, platform, level))
+            minx, miny, maxx, maxy = geometry.bounds
+            self._conn.execute("INSERT INTO searches_rtree VALUES (?, ?, ?, ?, ?)",
+                               (cursor.lastrowid, minx, maxx, miny, maxy))
@@ -1,76 +1,272 @@
-import rasterio
-from rasterio.mask import mask
-import geopandas as gp
-import os
-
-def clip_raster(raster_path, shapefile_path, output_path):
-    """
-        Clip a raster to the extent of a shapefile.
-
-        This function takes a raster file (raster_path) and a shapefile (shapefile_path) as input,
-        clips the raster to the extent of the shapefile, and writes the output to a new file
-        specified by output_path. The output raster will have the same resolution, projection,
-        and data type as the input raster.
-
-    Parameters:
-        raster_path (str): The file path to the input raster.
-        shapefile_path (str): The file path to the shapefile that will be used to clip the raster.
-        output_path (str): The file path to the output clipped raster.
-
-    Returns:
-        None
-            """
-    # Read the shapefile using geopandas
-    shapes = gp.read_file(shapefile_path)
-
-    # Read the raster using rasterio
-    with rasterio.open(raster_path) as src:
-        # Get the transform and bounding box of the raster
-        transform = src.transform
-        bbox = src.bounds
-
-        # Clip the raster using the bounding box of the shapefile
-        out_image, out_transform = rasterio.mask.mask(src, shapes.geometry, crop=True)
-        out_meta = src.meta.copy()
-
-        # Update the metadata of the output raster
-        out_meta.update({
-            "driver": "GTiff",
-            "height": out_image.shape[1],
-            "width": out_image.shape[2],
-            "transform": out_transform,
-        })
-
-        # Write the output raster
-        with rasterio.open(output_path, "w", **out_meta) as dest:
-            dest.write(out_image)
-
-def clip_all_bands(bands_path_list, shapefile_path, output_folder):
-    """
-        Clip multiple bands to the extent of a shapefile.
-
-        This function takes a list of band files (bands_path_list) and a shapefile (shapefile_path) as input,
-        clips all the bands to the extent of the shapefile, and writes the outputs to a new folder
-        specified by output_folder. The output rasters will have the same resolution, projection,
-        and data type as the input rasters. If the output folder does not exist, the function will create it.
-
-        If the output file already exists, it will be overwritten.
-
-    Parameters:
-        bands_path_list (List[str]): A list of file paths to the input bands.
-        shapefile_path (str): The file path to the shapefile that will be used to clip the bands.
-        output_folder (str): The folder path to store the output clipped bands.
-
-    Returns:
-        None
-            """
-
-    if not os.path.exists(output_folder):
-        os.makedirs(output_folder)
-    for band_path in bands_path_list:
-        band_name = band_path.split("\\")[-1].replace(".jp2", ".tif")
-        output_path = f"{output_folder}/{band_name}"
-        if os.path.exists(output_path):
-            os.remove(output_path)
-        clip_raster(band_path, shapefile_path, output_path)
-    
+import rasterio
+from rasterio.mask import raster_geometry_mask
+from rasterio.windows import union
+from shapely.geometry import box
+import geopandas as gp
+import hashlib
+import os
+from glob import glob
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from instrument import add_pixels, instrumented
+from raster_io import CogWriter
+
+# Window of the raster covering the AOI, mask of the pixels outside the AOI within that window,
+# and transform of the clipped raster
+ClipPlan = namedtuple('ClipPlan', ['window', 'mask', 'transform'])
+
+# Clip plans keyed by (raster grid, AOI), most recently used last
+MAX_CLIP_PLANS = 32
+_clip_plans = OrderedDict()
+_clip_plans_lock = threading.Lock()
+
+
+def aoi_key(shapes):
+    """
+    Return a key identifying the geometries of an AOI, used to cache clip plans.
+
+    Args:
+        shapes (geopandas.GeoDataFrame or Iterable[shapely geometry]): The AOI geometries.
+
+    Returns:
+        str: SHA-1 of the geometries in WKB.
+    """
+    geometries = shapes.geometry if hasattr(shapes, 'geometry') else shapes
+    digest = hashlib.sha1()
+    for geometry in geometries:
+        digest.update(geometry.wkb)
+    return digest.hexdigest()
+
+
+def plan_clip(src, shapes, key=None):
+    """
+    Compute the clip window, mask and output transform of an AOI on the grid of a raster.
+
+    Bands sharing the same grid (CRS, transform and size) share the same plan, so the plan is
+    computed once per (grid, AOI) pair and cached.
+
+    Args:
+        src (rasterio.DatasetReader): An open raster on the grid to clip.
+        shapes (geopandas.GeoDataFrame): The AOI geometries, in the CRS of the raster.
+        key (str): Cache key of the AOI, computed with aoi_key if not given.
+
+    Returns:
+        ClipPlan: The window, mask and transform of the clipped raster.
+    """
+    grid = (src.crs.to_wkt() if src.crs else None, tuple(src.transform), src.width, src.height)
+    cache_key = (grid, key or aoi_key(shapes))
+    with _clip_plans_lock:
+        if cache_key in _clip_plans:
+            _clip_plans.move_to_end(cache_key)
+            return _clip_plans[cache_key]
+        # Same window and mask as rasterio.mask.mask(src, shapes, crop=True)
+        shape_mask, transform, window = raster_geometry_mask(src, shapes.geometry, crop=True)
+        plan = ClipPlan(window, shape_mask, transform)
+        _clip_plans[cache_key] = plan
+        if len(_clip_plans) > MAX_CLIP_PLANS:
+            _clip_plans.popitem(last=False)
+    return plan
+
+
+@instrumented()
+def clip_raster(raster_path, shapefile_path, output_path, shapes=None, key=None):
+    """
+        Clip a raster to the extent of a shapefile.
+
+        This function takes a raster file (raster_path) and a shapefile (shapefile_path) as input,
+        clips the raster to the extent of the shapefile, and writes the output to a new file
+        specified by output_path. The output raster will have the same resolution, projection,
+        and data type as the input raster.
+
+    Parameters:
+        raster_path (str): The file path to the input raster.
+        shapefile_path (str): The file path to the shapefile that will be used to clip the raster.
+        output_path (str): The file path to the output clipped raster.
+        shapes (geopandas.GeoDataFrame): The already loaded shapefile, to avoid reading it again.
+        key (str): Cache key of the shapes, see aoi_key.
+
+    Returns:
+        None
+            """
+    # Read the shapefile using geopandas
+    if shapes is None:
+        shapes = gp.read_file(shapefile_path)
+
+    # Read the raster using rasterio
+    with rasterio.open(raster_path) as src:
+        plan = plan_clip(src, shapes, key)
+
+        # Decode only the window covering the shapefile and write it masked to the shapefile
+        out_image = src.read(window=plan.window, out_shape=(src.count,) + plan.mask.shape, masked=True)
+        _write_clipped(src, out_image, plan, output_path)
+        add_pixels(out_image.size)
+
+
+def _write_clipped(src, out_image, plan, output_path):
+    # Mask the pixels outside the AOI and write the clipped raster
+    nodata = src.nodata if src.nodata is not None else 0
+    out_image.mask = out_image.mask | plan.mask
+    out_image = out_image.filled(nodata)
+
+    # Write the output raster as a cloud-optimized GeoTIFF with the data type of the input
+    with CogWriter(output_path, out_image.shape[1], out_image.shape[2], src.crs, plan.transform,
+                   count=src.count, dtype=src.dtypes[0], nodata=nodata) as dest:
+        dest.write(out_image)
+
+def clip_all_bands(bands_path_list, shapefile_path, output_folder, workers=None):
+    """
+        Clip multiple bands to the extent of a shapefile.
+
+        This function takes a list of band files (bands_path_list) and a shapefile (shapefile_path) as input,
+        clips all the bands to the extent of the shapefile, and writes the outputs to a new folder
+        specified by output_folder. The output rasters will have the same resolution, projection,
+        and data type as the input rasters. If the output folder does not exist, the function will create it.
+
+        The shapefile is read once and the clip window and mask are computed once per band grid,
+        then the bands are clipped in parallel threads.
+
+        If the output file already exists, it will be overwritten.
+
+    Parameters:
+        bands_path_list (List[str]): A list of file paths to the input bands.
+        shapefile_path (str): The file path to the shapefile that will be used to clip the bands.
+        output_folder (str): The folder path to store the output clipped bands.
+        workers (int): Number of bands clipped at the same time, defaults to one per band up to the number of CPUs.
+
+    Returns:
+        None
+            """
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    shapes = gp.read_file(shapefile_path)
+    key = aoi_key(shapes)
+
+    def clip_band(band_path):
+        band_name = os.path.basename(band_path).replace(".jp2", ".tif")
+        output_path = f"{output_folder}/{band_name}"
+        if os.path.exists(output_path):
+            os.remove(output_path)
+        clip_raster(band_path, shapefile_path, output_path, shapes=shapes, key=key)
+
+    with ThreadPoolExecutor(max_workers=workers or max(min(len(bands_path_list), os.cpu_count() or 1), 1)) as executor:
+        # list() re-raises the first error of any band
+        list(executor.map(clip_band, bands_path_list))
+
+
+def list_aois(aois):
+    """
+        List the AOI files of a batch clip.
+
+    Parameters:
+        aois (str or List[str]): A folder of AOI GeoJSON files, or a list of AOI file paths.
+
+    Returns:
+        dict: AOI name (file name without extension) -> file path.
+            """
+    if isinstance(aois, str) and os.path.isdir(aois):
+        aois = sorted(glob(os.path.join(aois, "*.geojson")))
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in aois}
+
+
+def _touch(a, b):
+    # Whether two windows overlap or share an edge
+    return (a.col_off <= b.col_off + b.width and b.col_off <= a.col_off + a.width
+            and a.row_off <= b.row_off + b.height and b.row_off <= a.row_off + a.height)
+
+
+def group_windows(windows):
+    """
+    Group windows that overlap or touch, directly or through other windows of the group.
+
+    Reading the union of each group decodes every pixel at most once without reading the gaps
+    between AOIs far apart on a tile.
+
+    Args:
+        windows (dict): Name -> Window.
+
+    Returns:
+        list: (union window, names of the windows of the group) per group.
+    """
+    groups = [(window, [name]) for name, window in windows.items()]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                if _touch(groups[i][0], groups[j][0]):
+                    groups[i] = (union(groups[i][0], groups[j][0]), groups[i][1] + groups[j][1])
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return groups
+
+
+def clip_aois(bands_path_list, aois, output_folder, workers=None):
+    """
+        Clip multiple bands to many AOIs in a single pass over each band.
+
+        For every band, the AOIs that fall inside the band footprint are planned on the band grid,
+        the union of each group of overlapping or touching AOI windows is decoded once (see
+        group_windows), and each AOI is cut out of its block, masked and written to its own folder
+        output_folder/<AOI name>/. AOIs far apart are read separately, so the memory held per band
+        grows with the size of the AOIs, not with the distance between them. AOIs in another CRS than the bands
+        are reprojected to the band CRS, AOIs outside the band footprint are skipped.
+
+    Parameters:
+        bands_path_list (List[str]): A list of file paths to the input bands.
+        aois (str or List[str]): A folder of AOI GeoJSON files, or a list of AOI file paths.
+        output_folder (str): The folder path in which one folder per AOI is created.
+        workers (int): Number of bands clipped at the same time, defaults to one per band up to the number of CPUs.
+
+    Returns:
+        dict: AOI name -> folder of its clipped bands, for the AOIs inside the footprint of the bands.
+            """
+    shapes_by_aoi = {name: gp.read_file(path) for name, path in list_aois(aois).items()}
+    clipped = {}
+    clipped_lock = threading.Lock()
+
+    def clip_band(band_path):
+        band_name = os.path.basename(band_path).replace(".jp2", ".tif")
+        with rasterio.open(band_path) as src:
+            # Plan the AOIs that intersect the band footprint
+            footprint = box(*src.bounds)
+            plans = {}
+            for name, shapes in shapes_by_aoi.items():
+                if src.crs and shapes.crs and shapes.crs != src.crs:
+                    shapes = shapes.to_crs(src.crs)
+                if not shapes.geometry.intersects(footprint).any():
+                    continue
+                plans[name] = plan_clip(src, shapes)
+            if not plans:
+                return
+
+            # Decode each group of overlapping AOI windows once
+            for group_window, names in group_windows({name: plan.window for name, plan in plans.items()}):
+                block_window = group_window.round_offsets().round_lengths()
+                block = src.read(window=block_window, masked=True)
+                add_pixels(block.size)
+
+                for name in names:
+                    plan = plans[name]
+                    row = int(plan.window.row_off - block_window.row_off)
+                    col = int(plan.window.col_off - block_window.col_off)
+                    height, width = plan.mask.shape
+                    out_image = block[:, row:row + height, col:col + width].copy()
+                    aoi_folder = os.path.join(output_folder, name)
+                    os.makedirs(aoi_folder, exist_ok=True)
+                    output_path = f"{aoi_folder}/{band_name}"
+                    if os.path.exists(output_path):
+                        os.remove(output_path)
+                    _write_clipped(src, out_image, plan, output_path)
+                    with clipped_lock:
+                        clipped[name] = aoi_folder
+
+    with ThreadPoolExecutor(max_workers=workers or max(min(len(bands_path_list), os.cpu_count() or 1), 1)) as executor:
+        # list() re-raises the first error of any band
+        list(executor.map(clip_band, bands_path_list))
+    return clipped
@@ -0,0 +1,39 @@
+import numpy as np
+from rasterio.enums import Resampling
+
+from raster_io import read_on_grid
+from windowed import _open
+
+# Scene Classification Layer classes masked out of the indices: no data, saturated or defective,
+# cloud shadows, cloud medium probability, cloud high probability and thin cirrus
+SCL_MASKED_CLASSES = (0, 1, 3, 8, 9, 10)
+
+
+class SclMask:
+    """
+    Cloud mask of a window read from the Scene Classification Layer (SCL) of a product.
+
+    The 20 m SCL is read only over the window being processed and upsampled to the grid of the
+    10 m bands with nearest neighbour, so it is never resampled as a whole. Instances only hold
+    the path and classes, so they can be sent to the worker processes of the windowed engine.
+
+    Args:
+        path (str): Path of the SCL raster, clipped like the bands.
+        classes (Iterable[int]): SCL classes to mask.
+    """
+
+    def __init__(self, path, classes=SCL_MASKED_CLASSES):
+        self.path = path
+        self.classes = tuple(classes)
+
+    def read(self, window, transform):
+        """
+        Return the mask of a window of the band grid, True where the pixel is masked.
+
+        Args:
+            window (Window): Window of the band grid.
+            transform (Affine): Transform of the band grid.
+        """
+        # Pixels beyond the SCL extent read as class 0 (no data) and are masked
+        classes = read_on_grid(_open(self.path), window, transform, Resampling.nearest, fill_value=0)
+        return np.isin(classes, self.classes)
@@ -0,0 +1,324 @@
+import json
+import math
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+import rasterio
+from affine import Affine
+from rasterio.crs import CRS
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_geom
+from rasterio.windows import Window, transform as window_transform
+from shapely.geometry import shape
+
+from catalog import parse_date
+from raster_io import CogWriter, read_values
+
+# Rows and columns of the spatial chunks of a cube
+DEFAULT_CHUNK_SIZE = 256
+
+# Reductions over time available to Datacube.reduce
+REDUCERS = {
+    'max': np.nanmax,
+    'min': np.nanmin,
+    'mean': np.nanmean,
+    'median': np.nanmedian,
+}
+
+
+class Datacube:
+    """
+    Time series of index rasters of one AOI, stored as memory-mapped chunk files.
+
+    The grid of the AOI is split into spatial chunks. Every index has one raw float32 file per
+    chunk holding the chunk of every acquisition one after the other, (time, rows, cols) in C
+    order. Appending an acquisition adds one frame at the end of each chunk file and never
+    rewrites the earlier ones (replacing an acquisition rewrites only its own frame, in place),
+    and reading the time series of a pixel or a field only touches the chunks under it, a few
+    bytes per acquisition.
+
+    The grid, chunk size and acquisitions of each index are kept in cube.json, written last on
+    every append, so a chunk file longer than the recorded acquisitions (an interrupted append)
+    is truncated on the next append. The cube has a single writer.
+
+    Args:
+        root (str): Folder of the cube.
+        chunk_size (int): Rows and columns of the chunks of a new cube.
+    """
+
+    def __init__(self, root, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.root = root
+        self._meta_path = os.path.join(root, 'cube.json')
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {'chunk_size': chunk_size, 'grid': None, 'times': {}}
+
+    @property
+    def chunk_size(self):
+        return self.meta['chunk_size']
+
+    @property
+    def crs(self):
+        return CRS.from_wkt(self.meta['grid']['crs'])
+
+    @property
+    def transform(self):
+        return Affine(*self.meta['grid']['transform'])
+
+    @property
+    def shape(self):
+        return self.meta['grid']['height'], self.meta['grid']['width']
+
+    def times(self, index):
+        """
+        Return the acquisitions of an index as a DataFrame of date and product_id, in storage order.
+        """
+        return pd.DataFrame(self.meta['times'].get(index, []), columns=['date', 'product_id']).assign(
+            date=lambda df: pd.to_datetime(df['date']))
+
+    def append(self, index, path, date, product_id=None, replace=False):
+        """
+        Append an index raster as a new acquisition.
+
+        A raster on another grid is resampled to the grid of the cube. The raster is read one
+        row of chunks at a time.
+
+        Args:
+            index (str): Index name, e.g. 'ndvi'.
+            path (str): Path of the index raster.
+            date (datetime or str): Acquisition date.
+            product_id (str): Identifier of the product, used with the date to identify the acquisition.
+            replace (bool): Overwrite the frame of an acquisition already in the cube, e.g. after its
+                index was computed again, instead of skipping it.
+
+        Returns:
+            bool: False if the acquisition was already in the cube and not replaced.
+        """
+        date = parse_date(date).isoformat()
+        times = self.meta['times'].setdefault(index, [])
+        acquisition = [date, product_id]
+        if acquisition in times and not replace:
+            return False
+        position = times.index(acquisition) if acquisition in times else len(times)
+
+        with rasterio.open(path) as src:
+            if self.meta['grid'] is None:
+                self.meta['grid'] = {'crs': src.crs.to_wkt(), 'transform': list(src.transform)[:6],
+                                     'height': src.height, 'width': src.width}
+            height, width = self.shape
+            if src.crs == self.crs and src.transform == self.transform and (src.height, src.width) == (height, width):
+                self._write_frames(index, src, position, len(times))
+            else:
+                with WarpedVRT(src, crs=self.crs, transform=self.transform, height=height, width=width,
+                               resampling=Resampling.nearest, src_nodata=src.nodata, nodata=np.nan,
+                               dtype='float32') as vrt:
+                    # The warped values are the stored ones, the scale of a quantized raster is applied here
+                    self._write_frames(index, vrt, position, len(times), src.scales[0], src.offsets[0])
+
+        if position == len(times):
+            times.append(acquisition)
+        self._save()
+        return True
+
+    def append_indices(self, index_paths, date, product_id=None, replace=False):
+        """
+        Append the rasters of several indices of one acquisition, e.g. the output of process_indices.
+
+        Returns:
+            dict: Index name -> whether the acquisition was appended or replaced.
+        """
+        return {index: self.append(index, path, date, product_id, replace) for index, path in index_paths.items()}
+
+    def pixel_series(self, index, x, y, crs=None):
+        """
+        Return the time series of the pixel at a point.
+
+        Args:
+            index (str): Index name.
+            x (float): Coordinate of the point.
+            y (float): Coordinate of the point.
+            crs: CRS of the coordinates, defaults to the CRS of the cube.
+
+        Returns:
+            pd.Series: Index value by date, sorted by date, NaN where there is no data.
+        """
+        if crs is not None:
+            point = transform_geom(crs, self.crs, {'type': 'Point', 'coordinates': (x, y)})
+            x, y = point['coordinates']
+        col, row = ~self.transform * (x, y)
+        row, col = int(math.floor(row)), int(math.floor(col))
+        height, width = self.shape
+        if not (0 <= row < height and 0 <= col < width):
+            raise ValueError(f"Point ({x}, {y}) is outside the cube")
+        values = self.read(index, Window(col, row, 1, 1))[:, 0, 0]
+        return self._series(index, values)
+
+    def field_series(self, index, geometry, crs=None, statistic='mean'):
+        """
+        Return the time series of a statistic of the pixels of a field.
+
+        Only the chunks under the bounding box of the field are read.
+
+        Args:
+            index (str): Index name.
+            geometry (dict or shapely geometry): The field polygon.
+            crs: CRS of the geometry, defaults to the CRS of the cube.
+            statistic (str): 'mean', 'median', 'min' or 'max'.
+
+        Returns:
+            pd.Series: Statistic by date, sorted by date, NaN when the field has no valid pixel.
+        """
+        if hasattr(geometry, '__geo_interface__'):
+            geometry = geometry.__geo_interface__
+        if crs is not None:
+            geometry = transform_geom(crs, self.crs, geometry)
+        window = self._bounds_window(shape(geometry).bounds)
+        count = len(self.meta['times'].get(index, []))
+        if window is None:
+            return self._series(index, np.full(count, np.nan, dtype=np.float32))
+        inside = ~geometry_mask([geometry], out_shape=(window.height, window.width),
+                                transform=window_transform(window, self.transform))
+        values = self.read(index, window)[:, inside]
+        if values.shape[1] == 0:
+            return self._series(index, np.full(count, np.nan, dtype=np.float32))
+        with np.errstate(all='ignore'), warnings.catch_warnings():
+            # Acquisitions without any valid pixel in the field give NaN
+            warnings.simplefilter('ignore', RuntimeWarning)
+            result = REDUCERS[statistic](values, axis=1)
+        return self._series(index, result)
+
+    def read(self, index, window=None):
+        """
+        Read the frames of an index over a window of the grid.
+
+        Returns:
+            numpy.ndarray: float32 array of shape (acquisitions, rows, cols), in storage order.
+        """
+        height, width = self.shape
+        window = window or Window(0, 0, width, height)
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        rows, cols = int(window.height), int(window.width)
+        count = len(self.meta['times'].get(index, []))
+        out = np.full((count, rows, cols), np.nan, dtype=np.float32)
+        if count == 0:
+            return out
+
+        size = self.chunk_size
+        for chunk_row in range(row_off // size, (row_off + rows - 1) // size + 1):
+            for chunk_col in range(col_off // size, (col_off + cols - 1) // size + 1):
+                frames = self._chunk(index, chunk_row, chunk_col, count)
+                top, left = chunk_row * size, chunk_col * size
+                r0, r1 = max(row_off, top), min(row_off + rows, top + frames.shape[1])
+                c0, c1 = max(col_off, left), min(col_off + cols, left + frames.shape[2])
+                out[:, r0 - row_off:r1 - row_off, c0 - col_off:c1 - col_off] = \
+                    frames[:, r0 - top:r1 - top, c0 - left:c1 - left]
+        return out
+
+    def reduce(self, index, reducer='max', start=None, end=None, output_path=None):
+        """
+        Reduce the acquisitions of an index over time, e.g. a maximum NDVI composite of a season.
+
+        The reduction runs chunk by chunk, so memory stays bounded by one chunk of every acquisition.
+
+        Args:
+            index (str): Index name.
+            reducer (str): Key of REDUCERS.
+            start (datetime or str): First date included, None for no limit.
+            end (datetime or str): Last date included, None for no limit.
+            output_path (str): Path of the cloud-optimized GeoTIFF to write, None to only return the array.
+
+        Returns:
+            numpy.ndarray: float32 array of the grid, NaN where no acquisition has data.
+        """
+        dates = self.times(index)['date']
+        selected = np.ones(len(dates), dtype=bool)
+        if start is not None:
+            selected &= (dates >= parse_date(start)).to_numpy()
+        if end is not None:
+            selected &= (dates <= parse_date(end)).to_numpy()
+
+        height, width = self.shape
+        size = self.chunk_size
+        result = np.full((height, width), np.nan, dtype=np.float32)
+        if selected.any():
+            for chunk_row in range(math.ceil(height / size)):
+                for chunk_col in range(math.ceil(width / size)):
+                    frames = self._chunk(index, chunk_row, chunk_col, len(dates))[selected]
+                    with np.errstate(all='ignore'), warnings.catch_warnings():
+                        # Pixels without any valid acquisition give NaN
+                        warnings.simplefilter('ignore', RuntimeWarning)
+                        reduced = REDUCERS[reducer](frames, axis=0)
+                    result[chunk_row * size:chunk_row * size + frames.shape[1],
+                           chunk_col * size:chunk_col * size + frames.shape[2]] = reduced
+
+        if output_path:
+            with CogWriter(output_path, height, width, self.crs, self.transform) as dst:
+                dst.write(result, 1)
+        return result
+
+    def _bounds_window(self, bounds):
+        # Window of the grid covering bounds, None if they do not overlap the grid
+        minx, miny, maxx, maxy = bounds
+        cols, rows = zip(*(~self.transform * corner for corner in ((minx, miny), (maxx, maxy))))
+        height, width = self.shape
+        row_start, row_stop = max(int(math.floor(min(rows))), 0), min(int(math.ceil(max(rows))), height)
+        col_start, col_stop = max(int(math.floor(min(cols))), 0), min(int(math.ceil(max(cols))), width)
+        if row_start >= row_stop or col_start >= col_stop:
+            return None
+        return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+    def _chunk_path(self, index, chunk_row, chunk_col):
+        return os.path.join(self.root, index, f'{chunk_row}_{chunk_col}.f32')
+
+    def _chunk_shape(self, chunk_row, chunk_col):
+        height, width = self.shape
+        size = self.chunk_size
+        return min(size, height - chunk_row * size), min(size, width - chunk_col * size)
+
+    def _chunk(self, index, chunk_row, chunk_col, count):
+        # Memory map of the first count frames of a chunk file
+        rows, cols = self._chunk_shape(chunk_row, chunk_col)
+        return np.memmap(self._chunk_path(index, chunk_row, chunk_col), dtype=np.float32, mode='r',
+                         shape=(count, rows, cols))
+
+    def _write_frames(self, index, src, position, count, scale=1.0, offset=0.0):
+        # Write the frame of acquisition number position of count recorded ones, at the end when
+        # position == count
+        os.makedirs(os.path.join(self.root, index), exist_ok=True)
+        height, width = self.shape
+        size = self.chunk_size
+        for chunk_row in range(math.ceil(height / size)):
+            # One row of chunks at a time
+            strip = read_values(src, 1, window=Window(0, chunk_row * size, width, min(size, height - chunk_row * size)))
+            if scale != 1 or offset != 0:
+                strip = strip * scale + offset
+            for chunk_col in range(math.ceil(width / size)):
+                path = self._chunk_path(index, chunk_row, chunk_col)
+                rows, cols = self._chunk_shape(chunk_row, chunk_col)
+                expected = count * rows * cols * 4
+                if os.path.exists(path) and os.path.getsize(path) > expected:
+                    # Frame left by an interrupted append
+                    os.truncate(path, expected)
+                frame = np.ascontiguousarray(strip[:, chunk_col * size:chunk_col * size + cols], dtype=np.float32)
+                with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+                    f.seek(position * rows * cols * 4)
+                    f.write(frame.tobytes())
+
+    def _series(self, index, values):
+        times = self.times(index)
+        series = pd.Series(values, index=pd.DatetimeIndex(times['date'], name='date'), name=index)
+        return series.sort_index()
+
+    def _save(self):
+        os.makedirs(self.root, exist_ok=True)
+        tmp = f'{self._meta_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, self._meta_path)
+
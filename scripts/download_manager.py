@@ -0,0 +1,276 @@
+# Importing Libaraies
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from glob import glob
+
+import requests
+
+# Resolution of the Sentinel-2 L2A band files downloaded for each band
+BAND_RESOLUTION = {
+    'B02': 10, 'B03': 10, 'B04': 10, 'B08': 10,
+    'B05': 20, 'B06': 20, 'B07': 20, 'B8A': 20, 'B11': 20, 'B12': 20, 'SCL': 20,
+    'B01': 60, 'B09': 60,
+}
+DEFAULT_BANDS = ('B02', 'B03', 'B04', 'B08')
+CHUNK_SIZE = 1024 * 1024
+
+
+def band_filter(bands):
+    """
+    Build a sentinelsat node filter selecting the L2A files of some bands.
+
+    Args:
+        bands (Iterable[str]): Band names, keys of BAND_RESOLUTION.
+
+    Returns:
+        callable: Node filter for SentinelAPI.download, matching file paths case-insensitively.
+    """
+    patterns = [f"*_{band}_{BAND_RESOLUTION[band]}m.jp2".lower() for band in bands]
+
+    def node_filter(node_info):
+        node_path = node_info["node_path"].lower()
+        return any(fnmatch.fnmatch(node_path, pattern) for pattern in patterns)
+    return node_filter
+
+
+def file_checksum(path, algorithm='md5'):
+    """
+    Compute the checksum of a file.
+
+    Args:
+        path (str): Path of the file.
+        algorithm (str): Any hashlib algorithm name, e.g. 'md5' or 'sha256'.
+
+    Returns:
+        str: Hex digest of the file content.
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_file(url, dest, checksum=None, algorithm='md5', session=None, auth=None, retries=3):
+    """
+    Download a file over HTTP, resuming a previous partial download.
+
+    The file is written to dest + '.part' and continued with a Range request when the part
+    file already exists. It is moved to dest only once complete and, if a checksum is given,
+    verified.
+
+    Args:
+        url (str): URL of the file.
+        dest (str): Path of the downloaded file.
+        checksum (str): Expected hex digest of the file, or None to skip the verification.
+        algorithm (str): Hash algorithm of the checksum.
+        session (requests.Session): Session to reuse connections, a new one is created if None.
+        auth (tuple): Optional (user, password) for HTTP basic authentication.
+        retries (int): Attempts before giving up, a failed checksum restarts from scratch.
+
+    Returns:
+        str: dest
+
+    Raises:
+        IOError: If the file could not be downloaded or its checksum never matched.
+    """
+    session = session or requests.Session()
+    part = dest + '.part'
+    os.makedirs(os.path.dirname(os.path.abspath(dest)), exist_ok=True)
+
+    for attempt in range(retries):
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with session.get(url, headers=headers, auth=auth, stream=True, timeout=60) as response:
+                if response.status_code == 416:
+                    # The part file is already complete
+                    pass
+                else:
+                    response.raise_for_status()
+                    # A server ignoring the Range header sends the whole file again
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    with open(part, mode) as f:
+                        for chunk in response.iter_content(CHUNK_SIZE):
+                            f.write(chunk)
+        except requests.RequestException as error:
+            print(f"Download of {url} interrupted ({error}), retrying")
+            continue
+
+        if checksum is None or file_checksum(part, algorithm) == checksum.lower():
+            os.replace(part, dest)
+            return dest
+        print(f"Checksum mismatch for {url}, downloading again")
+        os.remove(part)
+
+    raise IOError(f"Could not download {url} after {retries} attempts")
+
+
+class ProductCache:
+    """
+    Local content-addressed store of downloaded band files, keyed by product UUID and band.
+
+    Files are stored as <root>/<uuid>/<band>/<file name>, and <root>/<uuid>/manifest.json
+    records the SHA-256 and size of every band file of the product.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _manifest_path(self, uuid):
+        return os.path.join(self.root, uuid, 'manifest.json')
+
+    def manifest(self, uuid):
+        path = self._manifest_path(uuid)
+        if not os.path.exists(path):
+            return {}
+        with open(path) as f:
+            return json.load(f)
+
+    def get(self, uuid, band, verify=False):
+        """
+        Return the cached file of a band, or None if it is not cached (or is corrupted when verify is True).
+        """
+        entry = self.manifest(uuid).get(band)
+        if entry is None:
+            return None
+        path = os.path.join(self.root, uuid, band, entry['filename'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            return None
+        if verify and file_checksum(path, 'sha256') != entry['sha256']:
+            return None
+        return path
+
+    def put(self, uuid, band, src_path):
+        """
+        Move a downloaded band file into the cache and record it in the manifest.
+
+        Returns:
+            str: Path of the cached file.
+        """
+        filename = os.path.basename(src_path)
+        band_folder = os.path.join(self.root, uuid, band)
+        os.makedirs(band_folder, exist_ok=True)
+        path = os.path.join(band_folder, filename)
+        entry = {'filename': filename, 'sha256': file_checksum(src_path, 'sha256'), 'size': os.path.getsize(src_path)}
+        os.replace(src_path, path)
+
+        with self._lock:
+            manifest = self.manifest(uuid)
+            manifest[band] = entry
+            # Write then rename so a crash never leaves a truncated manifest
+            tmp = self._manifest_path(uuid) + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(manifest, f, indent=2)
+            os.replace(tmp, self._manifest_path(uuid))
+        return path
+
+
+class DownloadManager:
+    """
+    Concurrent band downloader backed by a ProductCache.
+
+    Band files already in the cache are returned without touching the network. Missing ones
+    are downloaded by a bounded pool of threads, one task per (product, band), through
+    api.download with a node filter selecting the band file; sentinelsat resumes partial
+    downloads and verifies their MD5 checksum. When resolve is given, band files are instead
+    fetched with download_file from the (url, md5) it returns.
+
+    The api only needs a download(uuid, directory_path, nodefilter=..., checksum=True) method,
+    so a fake SentinelAPI can stand in for the Copernicus hub.
+    """
+
+    def __init__(self, api, cache_dir, workers=4, resolve=None, auth=None):
+        self.api = api
+        self.cache = ProductCache(cache_dir)
+        self.workers = workers
+        self.resolve = resolve
+        self.auth = auth
+        self.staging = os.path.join(cache_dir, '.staging')
+        self._local = threading.local()
+
+    def is_cached(self, uuid, bands=DEFAULT_BANDS):
+        return all(self.cache.get(uuid, band) is not None for band in bands)
+
+    def fetch(self, product_ids, bands=DEFAULT_BANDS):
+        """
+        Make sure the band files of the products are in the cache.
+
+        Args:
+            product_ids (Iterable[str]): Product UUIDs.
+            bands (Iterable[str]): Band names, keys of BAND_RESOLUTION.
+
+        Returns:
+            dict: uuid -> {band: path of the cached file}
+        """
+        results = {uuid: {} for uuid in product_ids}
+        missing = []
+        for uuid in results:
+            for band in bands:
+                path = self.cache.get(uuid, band)
+                if path is None:
+                    missing.append((uuid, band))
+                else:
+                    results[uuid][band] = path
+
+        if missing:
+            print(f"Downloading {len(missing)} band files, {sum(map(len, results.values()))} already cached")
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                for (uuid, band), path in zip(missing, executor.map(lambda item: self._fetch_band(*item), missing)):
+                    results[uuid][band] = path
+        return results
+
+    def _session(self):
+        # One HTTP session per worker thread, reused across its downloads
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _fetch_band(self, uuid, band):
+        staging = os.path.join(self.staging, uuid, band)
+        os.makedirs(staging, exist_ok=True)
+
+        if self.resolve is not None:
+            url, md5 = self.resolve(uuid, band)
+            path = download_file(url, os.path.join(staging, os.path.basename(url.split('?')[0])),
+                                 checksum=md5, session=self._session(), auth=self.auth)
+        else:
+            self.api.download(uuid, staging, nodefilter=band_filter([band]), checksum=True)
+            files = glob(os.path.join(staging, '**', f"*_{band}_{BAND_RESOLUTION[band]}m.jp2"), recursive=True)
+            if not files:
+                raise IOError(f"Band {band} of product {uuid} was not downloaded")
+            path = files[0]
+
+        cached = self.cache.put(uuid, band, path)
+        shutil.rmtree(staging, ignore_errors=True)
+        return cached
+
+    def materialize(self, band_paths, folder):
+        """
+        Expose cached band files in a folder, hard-linked when possible and copied otherwise.
+
+        Args:
+            band_paths (dict): band -> cached file path, as returned by fetch for one product.
+            folder (str): Destination folder, e.g. <download_path>/<title>.SAFE.
+
+        Returns:
+            list: Paths of the band files in the folder.
+        """
+        os.makedirs(folder, exist_ok=True)
+        paths = []
+        for path in band_paths.values():
+            dest = os.path.join(folder, os.path.basename(path))
+            if not os.path.exists(dest):
+                try:
+                    os.link(path, dest)
+                except OSError:
+                    shutil.copy2(path, dest)
+            paths.append(dest)
+        return paths
@@ -1,45 +1,123 @@
-# Importing Libaraies
-from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt, make_path_filter
-import pandas as pd
-import requests
-import json
-
-def download_sentinel2_data(footprint, date_range, cloudcoverpercentage, api, download_path):
-    """
-    Downloads Sentinel-2 Level-2A imagery for a given footprint and time range, with specified cloud cover percentage.
-
-    Args:
-    - footprint (str): geojson format of the area of interest.
-    - date_range (str): Start and end date in the format 'yyyy-mm-dd /yyyy-mm-dd'.
-    - cloudcoverpercentage (tuple): Tuple of minimum and maximum cloud cover percentage.
-    - api (sentinelhub.SentinelHub): Instance of the Sentinel Hub API.
-    - download_path (str): Local directory path to download the imagery.
-
-    Returns:
-    - product_id (str): Unique identifier of the downloaded product.
-
-    Raises:
-    - Exception: If no image is available under given specification, an exception is raised.
-
-    """
-    try:
-        products = api.query(footprint,
-                         date=date_range,
-                         platformname='Sentinel-2',
-                         processinglevel='Level-2A',
-                         cloudcoverpercentage=cloudcoverpercentage,
-                     )
-        products_gdf = api.to_geodataframe(products)
-        products_gdf_sorted = products_gdf.sort_values(['cloudcoverpercentage'], ascending=[True])
-    except:
-        print("No image is available under given specification, kindly check the date period or cloud coverage")
-
-    df = pd.DataFrame(products_gdf_sorted, columns= ['title', 'link', 'uuid'])
-    result = df.iloc[1,2]
-    product_id = str(result)
-    
-    path_filter = make_path_filter("*_B0[2348]_10m.jp2")
-    print("Start Downloading Bands")
-    api.download(product_id, download_path, nodefilter=path_filter)
-    print("Downloaded Bands")
-    return product_id
+# Importing Libaraies
+from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt, make_path_filter
+import pandas as pd
+import requests
+import json
+import os
+
+from download_manager import DEFAULT_BANDS, band_filter
+from selection import select_scenes
+
+
+def search_sentinel2_products(footprint, date_range, cloudcoverpercentage, api, catalog=None):
+    """
+    Query the Sentinel-2 Level-2A products for a footprint, time range and cloud cover percentage.
+
+    Args:
+    - footprint (str): WKT of the area of interest.
+    - date_range (tuple): Start and end date, e.g. ('20220901', '20221130').
+    - cloudcoverpercentage (tuple): Tuple of minimum and maximum cloud cover percentage.
+    - api (sentinelsat.SentinelAPI): Instance of the Copernicus hub API.
+    - catalog (Catalog): Optional local catalog. When given, the search is answered from it and
+      only the dates it has never searched are queried on the hub.
+
+    Returns:
+    - products_gdf (geopandas.GeoDataFrame): The products found, sorted by cloud cover percentage.
+
+    Raises:
+    - Exception: If no image is available under given specification, an exception is raised.
+    """
+    if catalog is not None:
+        products_gdf = catalog.search(api, footprint, date_range, cloudcoverpercentage)
+    else:
+        products = api.query(footprint,
+                             date=date_range,
+                             platformname='Sentinel-2',
+                             processinglevel='Level-2A',
+                             cloudcoverpercentage=cloudcoverpercentage,
+                         )
+        products_gdf = api.to_geodataframe(products)
+    if products_gdf.empty:
+        print("No image is available under given specification, kindly check the date period or cloud coverage")
+        raise Exception("No image is available under given specification")
+    return products_gdf.sort_values(['cloudcoverpercentage'], ascending=[True])
+
+
+def download_sentinel2_products(footprint, date_range, cloudcoverpercentage, api, download_path, manager=None,
+                                bands=DEFAULT_BANDS, min_coverage=0.99, max_products=None, catalog=None):
+    """
+    Downloads the smallest set of Sentinel-2 Level-2A products covering a footprint, and only the bands needed.
+
+    The products are chosen with select_scenes from their coverage of the footprint, cloud cover and
+    date, favouring products already in the cache of the download manager.
+
+    Args:
+    - footprint (str): WKT of the area of interest.
+    - date_range (tuple): Start and end date, e.g. ('20220901', '20221130').
+    - cloudcoverpercentage (tuple): Tuple of minimum and maximum cloud cover percentage.
+    - api (sentinelsat.SentinelAPI): Instance of the Copernicus hub API.
+    - download_path (str): Local directory path to download the imagery.
+    - manager (DownloadManager): Optional download manager. When given, bands are downloaded
+      concurrently into its cache and linked into download_path/<title>.SAFE.
+    - bands (tuple): Band names to download, e.g. indices.required_bands(['ndvi', 'evi']).
+    - min_coverage (float): Fraction of the footprint the selected products must cover.
+    - max_products (int): Maximum number of products to download, None for no limit.
+    - catalog (Catalog): Optional local catalog answering the search and recording the band files.
+
+    Returns:
+    - product_ids (list): Identifiers of the downloaded products, best first.
+
+    Raises:
+    - Exception: If no image is available under given specification, an exception is raised.
+    """
+    products_gdf = search_sentinel2_products(footprint, date_range, cloudcoverpercentage, api, catalog)
+    cached = [str(uuid) for uuid in products_gdf['uuid'] if manager is not None and manager.is_cached(str(uuid), bands)]
+    selected = select_scenes(products_gdf, footprint, min_coverage=min_coverage, max_products=max_products,
+                             cached=cached)
+    if selected.empty:
+        raise Exception("No image intersects the area of interest")
+    product_ids = [str(uuid) for uuid in selected['uuid']]
+    print(f"Selected {len(product_ids)} products covering {selected['coverage'].sum():.1%} of the area of interest")
+
+    print("Start Downloading Bands")
+    if manager is not None:
+        band_paths = manager.fetch(product_ids, bands)
+        for product_id, title in zip(product_ids, selected['title']):
+            manager.materialize(band_paths[product_id], os.path.join(download_path, f"{title}.SAFE"))
+            if catalog is not None:
+                catalog.set_band_files(product_id, band_paths[product_id])
+    else:
+        path_filter = band_filter(bands)
+        for product_id in product_ids:
+            api.download(product_id, download_path, nodefilter=path_filter)
+    print("Downloaded Bands")
+    return product_ids
+
+
+def download_sentinel2_data(footprint, date_range, cloudcoverpercentage, api, download_path, manager=None,
+                            bands=DEFAULT_BANDS, catalog=None):
+    """
+    Downloads Sentinel-2 Level-2A imagery for a given footprint and time range, with specified cloud cover percentage.
+
+    Args:
+    - footprint (str): geojson format of the area of interest.
+    - date_range (str): Start and end date in the format 'yyyy-mm-dd /yyyy-mm-dd'.
+    - cloudcoverpercentage (tuple): Tuple of minimum and maximum cloud cover percentage.
+    - api (sentinelhub.SentinelHub): Instance of the Sentinel Hub API.
+    - download_path (str): Local directory path to download the imagery.
+    - manager (DownloadManager): Optional download manager. When given, bands are downloaded
+      concurrently into its cache and linked into download_path/<title>.SAFE.
+    - bands (tuple): Band names to download.
+    - catalog (Catalog): Optional local catalog answering the search.
+
+    Returns:
+    - product_id (str): Unique identifier of the downloaded product.
+
+    Raises:
+    - Exception: If no image is available under given specification, an exception is raised.
+
+    The single best product for the footprint is downloaded, see download_sentinel2_products to
+    download every product needed to cover it.
+    """
+    return download_sentinel2_products(footprint, date_range, cloudcoverpercentage, api, download_path,
+                                       manager=manager, bands=bands, max_products=1, catalog=catalog)[0]
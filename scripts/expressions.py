@@ -0,0 +1,115 @@
+import ast
+import operator
+from functools import lru_cache
+
+import numpy as np
+
+# Arithmetic supported in index expressions, mapped to the numpy ufunc that evaluates it
+_BINARY = {
+    ast.Add: np.add,
+    ast.Sub: np.subtract,
+    ast.Mult: np.multiply,
+    ast.Div: np.true_divide,
+    ast.Pow: np.power,
+}
+_SCALAR = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.Pow: operator.pow,
+}
+_FUNCTIONS = {
+    'sqrt': np.sqrt,
+    'abs': np.absolute,
+}
+
+
+@lru_cache(maxsize=None)
+def compile_expression(expression):
+    """
+    Parse a band math expression and find the bands it needs.
+
+    Expressions use band names (e.g. B04, B8A) as variables, numeric constants, the operators
+    + - * / ** and the functions sqrt and abs.
+
+    Args:
+        expression (str): Band math expression, e.g. '(B08 - B04) / (B08 + B04)'.
+
+    Returns:
+        tuple: (parsed expression tree, sorted tuple of the band names it reads)
+
+    Raises:
+        ValueError: If the expression uses anything other than bands, constants and the supported operators.
+    """
+    tree = ast.parse(expression, mode='eval').body
+    bands = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            bands.add(node.id)
+        elif isinstance(node, ast.Call):
+            if not isinstance(node.func, ast.Name) or node.func.id not in _FUNCTIONS or len(node.args) != 1:
+                raise ValueError(f"Unsupported function call in index expression: {expression}")
+        elif isinstance(node, ast.BinOp) and type(node.op) not in _BINARY:
+            raise ValueError(f"Unsupported operator in index expression: {expression}")
+        elif isinstance(node, ast.UnaryOp) and not isinstance(node.op, (ast.USub, ast.UAdd)):
+            raise ValueError(f"Unsupported operator in index expression: {expression}")
+        elif isinstance(node, ast.Constant) and not isinstance(node.value, (int, float)):
+            raise ValueError(f"Unsupported constant in index expression: {expression}")
+        elif not isinstance(node, (ast.Name, ast.Call, ast.BinOp, ast.UnaryOp, ast.Constant,
+                                   ast.Load, ast.operator, ast.unaryop)):
+            raise ValueError(f"Unsupported syntax in index expression: {expression}")
+    # Function names are parsed as variables too, they are not bands
+    return tree, tuple(sorted(bands - set(_FUNCTIONS)))
+
+
+def evaluate(expression, bands):
+    """
+    Evaluate a band math expression over arrays.
+
+    Intermediate results are reused as the output buffer of the next operation (numpy out=),
+    so an expression allocates a single array however many sub-expressions it has. The input
+    band arrays are never modified and can be shared between expressions.
+
+    Args:
+        expression (str): Band math expression, see compile_expression.
+        bands (dict): Band name -> array.
+
+    Returns:
+        numpy.ndarray: The evaluated expression.
+    """
+    tree, _ = compile_expression(expression)
+    result, _ = _evaluate(tree, bands)
+    return result
+
+
+def _evaluate(node, bands):
+    # Returns (value, owned), where owned arrays are temporaries that can be overwritten in place
+    if isinstance(node, ast.Constant):
+        return node.value, False
+    if isinstance(node, ast.Name):
+        return bands[node.id], False
+    if isinstance(node, ast.UnaryOp):
+        value, owned = _evaluate(node.operand, bands)
+        if isinstance(node.op, ast.UAdd):
+            return value, owned
+        if not isinstance(value, np.ndarray):
+            return -value, False
+        return np.negative(value, out=value if owned else None), True
+    if isinstance(node, ast.Call):
+        value, owned = _evaluate(node.args[0], bands)
+        function = _FUNCTIONS[node.func.id]
+        if not isinstance(value, np.ndarray):
+            return float(function(value)), False
+        return function(value, out=value if owned else None), True
+
+    left, left_owned = _evaluate(node.left, bands)
+    right, right_owned = _evaluate(node.right, bands)
+    if not isinstance(left, np.ndarray) and not isinstance(right, np.ndarray):
+        return _SCALAR[type(node.op)](left, right), False
+    ufunc = _BINARY[type(node.op)]
+    if left_owned:
+        return ufunc(left, right, out=left), True
+    if right_owned:
+        return ufunc(left, right, out=right), True
+    return ufunc(left, right), True
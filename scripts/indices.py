@@ -1,176 +1,294 @@
-import os
-import rasterio
-import numpy as np
-
-
-def process_ndvi(folder):
-    
-    """
-     Process the normalized difference vegetation index (NDVI) for Sentinel-2 images in a folder.
-
-    Args:
-        folder (str): The path to the folder containing Sentinel-2 images.
-
-    Returns:
-        None
-
-    Raises:
-        ValueError: If the folder does not contain processed Sentinel-2 images with red and NIR bands.
-
-    This function calculates the NDVI from the red and NIR bands of Sentinel-2 images that have been processed 
-    and downloaded into the specified folder. It then writes the NDVI to a new GeoTIFF file in a subfolder called 'indices'.
-    The output file name is derived from the red band file name, with '_ndvi' appended to it. The output file has the same 
-    coordinate reference system (CRS) and spatial extent as the input red band file.
-
-    Example usage:
-    >>>> process_ndvi('/path/to/sentinel2_images/')
-    """
-    download = os.path.join(folder, 'download')
-    processed = os.path.join(folder, 'processed')
-    indices = os.path.join(folder, 'indices')
-    # Formula to calculate the ndvi
-    def calculate_ndvi(red, nir):
-        ndvi = (nir - red) / (nir + red)
-        return ndvi
-
-    red_file = None
-    nir_file = None
-
-    # Find the red and NIR bands in the folder
-    for filename in os.listdir(processed):
-        if 'B04' in filename:
-            red_file = os.path.join(processed, filename)
-        elif 'B08' in filename:
-            nir_file = os.path.join(processed, filename)
-
-    with rasterio.open(red_file) as src_red:
-        red = src_red.read(1).astype(np.float32) / 65535
-
-    with rasterio.open(nir_file) as src_nir:
-        nir = src_nir.read(1).astype(np.float32) / 65535
-
-    ndvi = calculate_ndvi(red, nir)
-
-    # Create the output folder if it doesn't exist
-    if not os.path.exists(indices):
-        os.makedirs(indices)
-
-    # Write the NDVI to a new TIFF file in the output folder
-    output_filename = os.path.splitext(os.path.basename(red_file))[0] + '_ndvi.tif'
-    with rasterio.open(os.path.join(indices, output_filename), 'w', driver='GTiff',
-                       height=ndvi.shape[0], width=ndvi.shape[1],
-                       count=1, dtype=np.float32, crs=src_red.crs, transform=src_red.transform) as dst:
-        dst.write(ndvi.astype(np.float32), 1)
-
-def process_gci(folder):
-    """
-    Process the Green Chlorophyll Index (GCI) for Sentinel-2 imagery in the given folder.
-
-    Parameters:
-        folder (str): Path to the folder containing Sentinel-2 imagery in the SAFE format.
-
-    Returns:
-        None.
-
-    Raises:
-        FileNotFoundError: If the input folder does not exist or does not contain the required bands.
-
-    This function reads the Green and Near-Infrared (NIR) bands from the Sentinel-2 imagery
-    in the input folder, calculates the GCI using the formula (NIR / Green) - 1, and writes
-    the resulting GCI to a new GeoTIFF file in a subfolder called "indices". The output
-    file has the same name as the input Green band file, with "_gci.tif" appended to it.
-
-    """
-    processed = os.path.join(folder, 'processed')
-    indices = os.path.join(folder, 'indices')
-    # Formula to calculate the GCI
-    def calculate_gci(green, nir):
-        gci = (nir / green) - 1
-        return gci
-
-    green_file = None
-    nir_file = None
-
-    # Find the Green and NIR bands in the folder
-    for filename in os.listdir(processed):
-        if 'B03' in filename:
-            green_file = os.path.join(processed, filename)
-        elif 'B08' in filename:
-            nir_file = os.path.join(processed, filename)
-
-    with rasterio.open(green_file) as src_green:
-        green = src_green.read(1).astype(np.float32) / 65535
-
-    with rasterio.open(nir_file) as src_nir:
-        nir = src_nir.read(1).astype(np.float32) / 65535
-
-    gci = calculate_gci(green, nir)
-
-    # Create the output folder if it doesn't exist
-    if not os.path.exists(indices):
-        os.makedirs(indices)
-
-    # Write the GCI to a new TIFF file in the output folder
-    output_filename = os.path.splitext(os.path.basename(green_file))[0] + '_gci.tif'
-    with rasterio.open(os.path.join(indices, output_filename), 'w', driver='GTiff',
-                       height=gci.shape[0], width=gci.shape[1],
-                       count=1, dtype=np.float32, crs=src_green.crs, transform=src_green.transform) as dst:
-        dst.write(gci.astype(np.float32), 1)
-
-def process_evi(folder):
-    """
-    Processes Enhanced Vegetation Index (EVI) from Sentinel-2 satellite data using the red, blue and NIR bands.
-    
-    Args:
-    folder (str): Path to the folder containing Sentinel-2 data files.
-    
-    Returns:
-    None
-    
-    This function searches for the blue, red and NIR band files in the specified folder, and uses them to calculate
-    the EVI. The calculated EVI is written to a new TIFF file in a subfolder named 'indices' in the same folder.
-    """
-    
-    processed = os.path.join(folder, 'processed')
-    indices = os.path.join(folder, 'indices')
-
-    def calculate_evi(red, blue, nir, lai=2.5, gain=2.5, offset=6):
-        evi = evi = gain * ((nir - red) / (nir + (lai * red) - (offset * blue) + 1))
-        return evi
-
-    blue_file = None
-    red_file = None
-    nir_file = None
-
-    # Find the blue, red and NIR bands in the folder
-    for filename in os.listdir(processed):
-        if 'B02' in filename:
-            blue_file = os.path.join(processed, filename)
-        if 'B04' in filename:
-            red_file = os.path.join(processed, filename)
-        elif 'B08' in filename:
-            nir_file = os.path.join(processed, filename)
-
-    with rasterio.open(blue_file) as src_blue:
-        blue = src_blue.read(1).astype(np.float32) / 65535
-
-    with rasterio.open(red_file) as src_red:
-        red = src_red.read(1).astype(np.float32) / 65535
-    
-    with rasterio.open(nir_file) as src_nir:
-        nir = src_nir.read(1).astype(np.float32) / 65535
-
-    evi = calculate_evi(red, blue, nir, lai=2.5, gain=2.5, offset=6)
-
-    # Create the output folder if it doesn't exist
-    if not os.path.exists(indices):
-        os.makedirs(indices)
-
-    # Write the EVI to a new TIFF file in the output folder
-    output_filename = os.path.splitext(os.path.basename(blue_file))[0] + '_evi.tif'
-    with rasterio.open(os.path.join(indices, output_filename), 'w', driver='GTiff',
-                       height=evi.shape[0], width=evi.shape[1],
-                       count=1, dtype=np.float32, crs=src_red.crs, transform=src_red.transform) as dst:
-        dst.write(evi.astype(np.float32), 1)    
-
-   
+import os
+import re
+from collections import namedtuple
+from functools import partial
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+
+from bandstack import WindowSource
+from cloudmask import SclMask
+from expressions import compile_expression, evaluate
+from instrument import instrumented
+from windowed import DEFAULT_WINDOW_BUDGET, run_windowed
+
+
+# Registry of the vegetation indices. Each index is an expression over Sentinel-2 band names;
+# name_band is the band whose processed file name is used to name the output file. Bands of
+# different resolutions (NDRE reads the 20 m B8A and B05) are resampled to the finest of them.
+IndexSpec = namedtuple('IndexSpec', ['expression', 'name_band'])
+
+INDICES = {
+    'ndvi': IndexSpec('(B08 - B04) / (B08 + B04)', 'B04'),
+    'gci': IndexSpec('(B08 / B03) - 1', 'B03'),
+    'evi': IndexSpec('2.5 * ((B08 - B04) / (B08 + (2.5 * B04) - (6 * B02) + 1))', 'B02'),
+    'savi': IndexSpec('1.5 * (B08 - B04) / (B08 + B04 + 0.5)', 'B04'),
+    'ndwi': IndexSpec('(B03 - B08) / (B03 + B08)', 'B03'),
+    'ndre': IndexSpec('(B8A - B05) / (B8A + B05)', 'B05'),
+}
+
+# Quantization step of the indices stored as scaled int16, chosen so the usual range of the
+# index fits in int16 (|value| < 3.2 with 1e-4, GCI goes above 3)
+INDEX_SCALES = {name: 1e-4 for name in INDICES}
+INDEX_SCALES['gci'] = 1e-3
+
+# Band names recognised in the processed file names
+BANDS = ('B01', 'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B08', 'B8A', 'B09', 'B11', 'B12', 'SCL')
+
+# Band token of a file name, e.g. _B04_10m in T30TVK_20220901T105631_B04_10m.tif: the band name
+# between separators, then the resolution in metres when given
+BAND_TOKEN = re.compile(r'(?:^|[_.-])(' + '|'.join(BANDS) + r')(?:_(\d+)m)?(?=[_.-]|$)')
+
+# Side files of GDAL next to the rasters and scratch files of interrupted writes, which are not bands
+SIDECAR_SUFFIXES = ('.aux.xml', '.ovr', '.msk', '.tmp.tif')
+
+
+def required_bands(names, cloud_mask=False):
+    """
+    Return the bands needed to compute a set of indices from the registry.
+
+    Args:
+        names (Iterable[str]): Index names, keys of INDICES.
+        cloud_mask (bool): Include the Scene Classification Layer used to mask clouds.
+
+    Returns:
+        tuple: Sorted band names read by at least one of the indices, and SCL with cloud_mask.
+    """
+    bands = set()
+    for name in names:
+        bands.update(compile_expression(INDICES[name].expression)[1])
+    if cloud_mask:
+        bands.add('SCL')
+    return tuple(sorted(bands))
+
+
+def find_bands(processed):
+    """
+    Find the band files in a folder of processed Sentinel-2 bands.
+
+    Args:
+        processed (str): Folder with one file per band, named after the band (e.g. ..._B04_10m.tif).
+
+    Returns:
+        dict: Band name -> file path.
+    """
+    return match_bands(os.path.join(processed, filename) for filename in os.listdir(processed))
+
+
+def match_bands(paths):
+    """
+    Match band files to band names by file name.
+
+    The band is the _<band>_ token of the name. When a band comes at several resolutions (e.g.
+    ..._B05_20m and ..._B05_60m of a SAFE product), the finest one is kept.
+
+    Args:
+        paths (Iterable[str]): Band files named after their band (e.g. ..._B04_10m.jp2).
+
+    Returns:
+        dict: Band name -> file path.
+
+    Raises:
+        ValueError: If several files hold the same band at the same resolution.
+    """
+    candidates = {}
+    for path in sorted(paths):
+        filename = os.path.basename(path)
+        if filename.lower().endswith(SIDECAR_SUFFIXES):
+            continue
+        match = BAND_TOKEN.search(filename)
+        if match is None:
+            continue
+        band, resolution = match.group(1), int(match.group(2)) if match.group(2) else None
+        candidates.setdefault(band, []).append((resolution, path))
+
+    band_files = {}
+    for band, files in candidates.items():
+        # Files without a resolution in their name come after those with one
+        files.sort(key=lambda item: (item[0] is None, item[0] or 0))
+        finest = [path for resolution, path in files if resolution == files[0][0]]
+        if len(finest) > 1:
+            raise ValueError(f"Several files for band {band}: {finest}")
+        band_files[band] = finest[0]
+    return band_files
+
+
+def align_bands(band_files, resampling=Resampling.bilinear):
+    """
+    Put band files of different resolutions on one grid for the windowed engine.
+
+    Bands already sharing a grid are returned unchanged. Otherwise each band becomes a
+    WindowSource on the grid of the finest band, so e.g. 20 m bands clipped to an AOI are
+    resampled on the fly to the 10 m grid of the other bands.
+
+    Args:
+        band_files (dict): Band name -> path of the band file.
+        resampling (Resampling): Resampling of the coarser bands.
+
+    Returns:
+        dict: Band name -> path or WindowSource.
+    """
+    grids = {}
+    for band, path in band_files.items():
+        with rasterio.open(path) as src:
+            grids[band] = (src.res, src.transform, src.width, src.height, src.crs, src.nodata, src.block_shapes[0])
+    if len({grid[1:4] for grid in grids.values()}) <= 1:
+        return dict(band_files)
+
+    reference = min(grids, key=lambda band: grids[band][0][0])
+    _, transform, width, height, crs, _, block_shape = grids[reference]
+    return {band: WindowSource(path, crs, transform, width, height, None,
+                               grids[band][5] if grids[band][5] is not None else 0,
+                               Resampling.nearest if band == 'SCL' else resampling, block_shape)
+            for band, path in band_files.items()}
+
+
+def _reflectance(band):
+    reflectance = band.astype(np.float32)
+    reflectance /= 65535
+    return reflectance
+
+# Per-window kernel run by the windowed engine, it must stay at module level to be picklable
+def _fused_kernel(names, **bands):
+    # Each band is converted to reflectance once and shared by every index
+    reflectance = {band: _reflectance(array) for band, array in bands.items()}
+    return {name: evaluate(INDICES[name].expression, reflectance) for name in names}
+
+
+@instrumented()
+def process_indices(folder, names=('ndvi', 'gci', 'evi'), window_budget=DEFAULT_WINDOW_BUDGET, workers=None,
+                    processed_folder=None, indices_folder=None, quantize=False, cloud_mask=False, stack=None):
+    """
+    Compute several vegetation indices from the processed Sentinel-2 bands in one fused pass.
+
+    The bands needed by all the requested indices are read once per window and every index is
+    evaluated from them, instead of reading the bands again for each index.
+
+    Args:
+        folder (str): The path to the folder containing the 'processed' bands.
+        names (Iterable[str]): Index names, keys of INDICES.
+        window_budget (int): Maximum bytes held in memory per processing window. None processes the whole band at once.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+        processed_folder (str): Folder of the bands, defaults to the 'processed' subfolder of folder.
+        indices_folder (str): Folder of the outputs, defaults to the 'indices' subfolder of folder.
+        quantize (bool): Store the indices as int16 scaled by INDEX_SCALES instead of float32,
+            which halves their size again at a precision below the sensor noise.
+        cloud_mask (bool): Mask clouds, cloud shadows and no data with the SCL band of the folder.
+            Masked pixels are NaN and windows without any clear pixel are not read at all.
+        stack (BandStack): Bands clipped on the fly from the source files, read instead of the
+            'processed' folder so no clipped band has to be written first.
+
+    The bands of the 'processed' folder may have different resolutions, e.g. the 20 m B8A and
+    B05 of NDRE next to 10 m bands: they are resampled to the grid of the finest band read (see
+    align_bands), and the outputs are on that grid.
+
+    Returns:
+        dict: Index name -> path of the written cloud-optimized GeoTIFF in the 'indices' subfolder.
+
+    Raises:
+        KeyError: If an index is not in the registry.
+        FileNotFoundError: If a band needed by the indices is missing from the 'processed' folder.
+    """
+    indices = indices_folder or os.path.join(folder, 'indices')
+    names = tuple(names)
+
+    # Find the bands needed by the indices in the folder or the stack
+    if stack is not None:
+        processed = 'the band stack'
+        band_files = stack.band_paths
+    else:
+        processed = processed_folder or os.path.join(folder, 'processed')
+        band_files = find_bands(processed)
+    missing = [band for band in required_bands(names, cloud_mask) if band not in band_files]
+    if missing:
+        raise FileNotFoundError(f"Bands {missing} not found in {processed}")
+    if stack is not None:
+        inputs = {band: stack.sources[band] for band in required_bands(names)}
+    else:
+        inputs = align_bands({band: band_files[band] for band in required_bands(names)})
+    mask = SclMask(band_files['SCL']) if cloud_mask else None
+
+    # Create the output folder if it doesn't exist
+    if not os.path.exists(indices):
+        os.makedirs(indices)
+
+    # The output file name is derived from the name band of each index
+    outputs = {}
+    for name in names:
+        name_file = band_files[INDICES[name].name_band]
+        outputs[name] = os.path.join(indices, os.path.splitext(os.path.basename(name_file))[0] + f'_{name}.tif')
+
+    scales = {name: INDEX_SCALES[name] for name in names} if quantize else None
+    run_windowed(partial(_fused_kernel, names), inputs, outputs, window_budget=window_budget, workers=workers,
+                 scales=scales, mask=mask)
+    return outputs
+
+
+def process_ndvi(folder, window_budget=DEFAULT_WINDOW_BUDGET, workers=None):
+    
+    """
+     Process the normalized difference vegetation index (NDVI) for Sentinel-2 images in a folder.
+
+    Args:
+        folder (str): The path to the folder containing Sentinel-2 images.
+        window_budget (int): Maximum bytes held in memory per processing window. None processes the whole band at once.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        str: Path of the written NDVI file.
+
+    Raises:
+        FileNotFoundError: If the folder does not contain processed Sentinel-2 images with red and NIR bands.
+
+    This function calculates the NDVI from the red and NIR bands of Sentinel-2 images that have been processed 
+    and downloaded into the specified folder. It then writes the NDVI to a new GeoTIFF file in a subfolder called 'indices'.
+    The output file name is derived from the red band file name, with '_ndvi' appended to it. The output file has the same 
+    coordinate reference system (CRS) and spatial extent as the input red band file.
+
+    Example usage:
+    >>>> process_ndvi('/path/to/sentinel2_images/')
+    """
+    return process_indices(folder, ['ndvi'], window_budget=window_budget, workers=workers)['ndvi']
+
+
+def process_gci(folder, window_budget=DEFAULT_WINDOW_BUDGET, workers=None):
+    """
+    Process the Green Chlorophyll Index (GCI) for Sentinel-2 imagery in the given folder.
+
+    Parameters:
+        folder (str): Path to the folder containing Sentinel-2 imagery in the SAFE format.
+        window_budget (int): Maximum bytes held in memory per processing window. None processes the whole band at once.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        str: Path of the written GCI file.
+
+    Raises:
+        FileNotFoundError: If the input folder does not exist or does not contain the required bands.
+
+    This function reads the Green and Near-Infrared (NIR) bands from the Sentinel-2 imagery
+    in the input folder, calculates the GCI using the formula (NIR / Green) - 1, and writes
+    the resulting GCI to a new GeoTIFF file in a subfolder called "indices". The output
+    file has the same name as the input Green band file, with "_gci.tif" appended to it.
+
+    """
+    return process_indices(folder, ['gci'], window_budget=window_budget, workers=workers)['gci']
+
+
+def process_evi(folder, window_budget=DEFAULT_WINDOW_BUDGET, workers=None):
+    """
+    Processes Enhanced Vegetation Index (EVI) from Sentinel-2 satellite data using the red, blue and NIR bands.
+    
+    Args:
+    folder (str): Path to the folder containing Sentinel-2 data files.
+    window_budget (int): Maximum bytes held in memory per processing window. None processes the whole band at once.
+    workers (int): Number of worker processes, defaults to the number of CPUs.
+    
+    Returns:
+    str: Path of the written EVI file.
+    
+    This function searches for the blue, red and NIR band files in the specified folder, and uses them to calculate
+    the EVI. The calculated EVI is written to a new TIFF file in a subfolder named 'indices' in the same folder.
+    """
+    return process_indices(folder, ['evi'], window_budget=window_budget, workers=workers)['evi']
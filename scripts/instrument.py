@@ -0,0 +1,223 @@
+"""
+Lightweight instrumentation of the pipeline stages.
+
+A stage is timed with the stage() context manager or the instrumented() decorator. It records
+wall time, CPU time (of the thread plus the worker processes reaped during the stage), bytes read
+from and written to storage by the process (Linux read_bytes and write_bytes of /proc/self/io,
+which include reaped worker processes but not sockets, pipes or page cache hits), pixels
+processed (reported by the stage with add_pixels) and the highest resident memory of the process
+and its live worker processes while the stage ran, sampled every RSS_SAMPLE_SECONDS. Every record
+is logged as one JSON line on the 'chm.metrics' logger and, after start_run(db_uri), stored in
+pa.pipeline_runs by flush().
+
+The I/O, memory and child CPU counters are process wide, so stages running at the same time in
+several threads share them.
+"""
+import functools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError):  # Windows
+    _PAGE_SIZE = 4096
+
+logger = logging.getLogger('chm.metrics')
+
+_local = threading.local()
+_lock = threading.Lock()
+_run = {'run_id': None, 'db_uri': None, 'sequence': 0, 'pending': [], 'retry_at': 0.0}
+
+# Seconds to wait before storing the records again after a failure
+FLUSH_RETRY_SECONDS = 60
+# Interval of the memory samples taken while stages run
+RSS_SAMPLE_SECONDS = 0.1
+
+# Records of the stages running, whose memory high-water mark the sampler thread updates
+_active = []
+_sampler = None
+
+
+def io_counters():
+    """
+    Return the (bytes read, bytes written) of the process so far, or (None, None) when unknown.
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+        return int(counters['read_bytes']), int(counters['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def _statm_rss(pid):
+    with open(f'/proc/{pid}/statm') as f:
+        return int(f.read().split()[1]) * _PAGE_SIZE
+
+
+def current_rss():
+    """
+    Return the resident memory in bytes of the process and of its live worker processes, or None
+    where /proc is not available.
+    """
+    try:
+        rss = _statm_rss('self')
+    except (OSError, ValueError, IndexError):
+        return None
+    children = set()
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open(f'/proc/self/task/{task}/children') as f:
+                children.update(f.read().split())
+    except OSError:
+        pass
+    for pid in children:
+        try:
+            rss += _statm_rss(pid)
+        except (OSError, ValueError, IndexError):
+            # The worker exited in the meantime
+            pass
+    return rss
+
+
+def _sample():
+    # Raise the memory high-water mark of the running stages until none is left
+    global _sampler
+    while True:
+        rss = current_rss()
+        with _lock:
+            if not _active or rss is None:
+                _sampler = None
+                return
+            for record in _active:
+                record['peak_rss_bytes'] = max(record['peak_rss_bytes'], rss)
+        time.sleep(RSS_SAMPLE_SECONDS)
+
+
+def _children_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+
+def start_run(db_uri=None):
+    """
+    Start a pipeline run; its stage records are stored in pa.pipeline_runs when db_uri is given.
+
+    Returns:
+        str: The identifier of the run.
+    """
+    with _lock:
+        _run.update(run_id=str(uuid.uuid4()), db_uri=db_uri, sequence=0, pending=[], retry_at=0.0)
+        return _run['run_id']
+
+
+def add_pixels(count):
+    """
+    Add processed pixels to the stages running in this thread.
+    """
+    for record in getattr(_local, 'stack', ()):
+        record['pixels'] += int(count)
+
+
+@contextmanager
+def stage(name, **labels):
+    """
+    Measure a stage of the pipeline.
+
+    Args:
+        name (str): Name of the stage, e.g. 'download' or 'process_indices'.
+        **labels: JSON-serializable details of the stage, e.g. product or AOI.
+
+    Yields:
+        dict: The record of the stage, filled in when the stage ends.
+    """
+    global _sampler
+    record = {'stage': name, 'labels': labels, 'started_at': datetime.utcnow().isoformat(), 'pixels': 0}
+    stack = _local.__dict__.setdefault('stack', [])
+    stack.append(record)
+    read, written = io_counters()
+    rss = current_rss()
+    if rss is not None:
+        record['peak_rss_bytes'] = rss
+        with _lock:
+            _active.append(record)
+            if _sampler is None:
+                _sampler = threading.Thread(target=_sample, name='rss-sampler', daemon=True)
+                _sampler.start()
+    cpu = time.thread_time() + _children_cpu()
+    started = time.perf_counter()
+    record['status'] = 'failed'
+    try:
+        yield record
+        record['status'] = 'done'
+    finally:
+        stack.pop()
+        record['wall_seconds'] = time.perf_counter() - started
+        record['cpu_seconds'] = time.thread_time() + _children_cpu() - cpu
+        end_read, end_written = io_counters()
+        record['bytes_read'] = end_read - read if read is not None else None
+        record['bytes_written'] = end_written - written if written is not None else None
+        rss = current_rss()
+        with _lock:
+            _active[:] = [active for active in _active if active is not record]
+            record['peak_rss_bytes'] = max(record.get('peak_rss_bytes') or 0, rss) if rss is not None else None
+            record['run_id'] = _run['run_id']
+            _run['sequence'] += 1
+            record['seq'] = _run['sequence']
+            if _run['db_uri']:
+                _run['pending'].append(record)
+        logger.info(json.dumps(record, default=str))
+
+
+def instrumented(name=None):
+    """
+    Decorator measuring every call of a function as a stage, named after the function by default.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def flush(force=False):
+    """
+    Store the records of the run not stored yet in pa.pipeline_runs.
+
+    A failure to store them (database down, table not migrated) is logged and the records are kept
+    for the next flush, which is not tried again before FLUSH_RETRY_SECONDS unless forced; the
+    metrics never fail the run they measure.
+
+    Returns:
+        int: The number of records stored.
+    """
+    with _lock:
+        if not force and time.monotonic() < _run['retry_at']:
+            return 0
+        pending, _run['pending'] = _run['pending'], []
+        db_uri = _run['db_uri']
+    if not pending or not db_uri:
+        return 0
+    try:
+        import pandas as pd
+        from db import upsert_dataframe
+        df = pd.DataFrame(pending)
+        df['labels'] = df['labels'].map(lambda labels: json.dumps(labels, default=str))
+        columns = ['run_id', 'seq', 'stage', 'labels', 'status', 'started_at', 'wall_seconds', 'cpu_seconds',
+                   'bytes_read', 'bytes_written', 'pixels', 'peak_rss_bytes']
+        df = df[columns].astype({'bytes_read': 'Int64', 'bytes_written': 'Int64', 'peak_rss_bytes': 'Int64'})
+        return upsert_dataframe(df, 'pipeline_runs', db_uri, schema='pa', key=('run_id', 'seq'), geometry_columns=())
+    except Exception as error:
+        logger.warning(json.dumps({'event': 'metrics_flush_failed', 'records': len(pending), 'error': repr(error)}))
+        with _lock:
+            _run['pending'][:0] = pending
+            _run['retry_at'] = time.monotonic() + FLUSH_RETRY_SECONDS
+        return 0
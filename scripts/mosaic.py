@@ -0,0 +1,216 @@
+import math
+import os
+import threading
+from functools import partial
+
+import geopandas as gp
+import numpy as np
+import rasterio
+from affine import Affine
+from rasterio.enums import Resampling
+from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import transform_bounds
+from rasterio.windows import bounds as window_bounds, transform as window_transform
+from shapely.geometry import mapping
+
+from catalog import parse_date
+from cloudmask import SCL_MASKED_CLASSES
+from instrument import instrumented
+from windowed import DEFAULT_WINDOW_BUDGET, run_windowed
+
+# Rules ordering the observations of a pixel, best first
+PRIORITIES = ('least_cloudy', 'latest')
+
+# Size of the processing blocks of the mosaic grid
+MOSAIC_BLOCK = 512
+
+# Warped views opened by each thread of a process, kept open between windows
+_local = threading.local()
+
+
+def _warped():
+    if not hasattr(_local, 'warped'):
+        _local.warped = {}
+    return _local.warped
+
+
+def target_grid(shapes, crs=None, resolution=10):
+    """
+    Compute a grid covering an AOI, with pixel edges on multiples of the resolution.
+
+    Args:
+        shapes (geopandas.GeoDataFrame): The AOI geometries.
+        crs: CRS of the grid, defaults to the UTM zone of the AOI.
+        resolution (float): Pixel size in units of the CRS.
+
+    Returns:
+        tuple: (crs, transform, width, height) of the grid.
+    """
+    crs = crs or shapes.estimate_utm_crs()
+    minx, miny, maxx, maxy = shapes.to_crs(crs).total_bounds
+    left = math.floor(minx / resolution) * resolution
+    top = math.ceil(maxy / resolution) * resolution
+    width = max(int(math.ceil((maxx - left) / resolution)), 1)
+    height = max(int(math.ceil((top - miny) / resolution)), 1)
+    return crs, Affine(resolution, 0, left, 0, -resolution, top), width, height
+
+
+class WarpedSource:
+    """
+    Window source reprojecting a band file of any CRS onto a target grid.
+
+    Windows are warped on demand through a WarpedVRT on the target grid, so only the source
+    blocks under a window are decoded. Windows outside the footprint of the file, and pixels
+    outside the AOI geometries, are nodata. Instances can be sent to worker processes.
+
+    Args:
+        path (str): Path of the band file.
+        crs: CRS of the target grid.
+        transform (Affine): Transform of the target grid.
+        width (int): Number of columns of the target grid.
+        height (int): Number of rows of the target grid.
+        geometries (list): AOI geometries as GeoJSON-like dicts in the target CRS, None for no mask.
+        resampling (Resampling): Resampling of the warp.
+    """
+
+    def __init__(self, path, crs, transform, width, height, geometries=None, resampling=Resampling.bilinear):
+        self.path = path
+        self.crs = crs
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.geometries = geometries
+        self.resampling = resampling
+        self.block_shape = (MOSAIC_BLOCK, MOSAIC_BLOCK)
+        with rasterio.open(path) as src:
+            self.nodata = src.nodata if src.nodata is not None else 0
+            self.dtype = src.dtypes[0]
+            self.bounds = transform_bounds(src.crs, crs, *src.bounds)
+
+    def read(self, window):
+        shape = (int(window.height), int(window.width))
+        left, bottom, right, top = window_bounds(window, self.transform)
+        b_left, b_bottom, b_right, b_top = self.bounds
+        if left >= b_right or right <= b_left or bottom >= b_top or top <= b_bottom:
+            return np.full(shape, self.nodata, dtype=self.dtype)
+
+        key = (self.path, str(self.crs), tuple(self.transform), self.width, self.height, self.resampling)
+        warped = _warped()
+        if key not in warped:
+            src = rasterio.open(self.path)
+            warped[key] = WarpedVRT(src, crs=self.crs, transform=self.transform, width=self.width,
+                                    height=self.height, resampling=self.resampling,
+                                    src_nodata=self.nodata, nodata=self.nodata)
+        data = warped[key].read(1, window=window)
+        if self.geometries:
+            outside = geometry_mask(self.geometries, out_shape=shape, transform=window_transform(window, self.transform))
+            data[outside] = self.nodata
+        return data
+
+
+def close_warped():
+    """
+    Close the warped views opened by the current thread.
+    """
+    warped = _warped()
+    for vrt in warped.values():
+        src = vrt.src_dataset
+        vrt.close()
+        src.close()
+    warped.clear()
+
+
+# Per-window kernel run by the windowed engine, it must stay at module level to be picklable
+def _mosaic_kernel(keys, bands, classes, **arrays):
+    # keys are the product prefixes of the inputs, best first; the first band tells where a
+    # product has data (0 is the no data value of the L2A bands)
+    reference = bands[0]
+    shape = arrays[f'{keys[0]}_{reference}'].shape
+    out = {band: np.full(shape, np.nan, dtype=np.float32) for band in bands}
+    filled = np.zeros(shape, dtype=bool)
+    for key in keys:
+        take = arrays[f'{key}_{reference}'] != 0
+        if f'{key}_SCL' in arrays:
+            take &= ~np.isin(arrays[f'{key}_SCL'], classes)
+        take &= ~filled
+        for band in bands:
+            out[band][take] = arrays[f'{key}_{band}'][take]
+        filled |= take
+        if filled.all():
+            break
+    return out
+
+
+@instrumented()
+def mosaic_products(products, shapes, output_folder, bands, priority='least_cloudy', cloud_mask=True,
+                    crs=None, resolution=10, window_budget=DEFAULT_WINDOW_BUDGET, workers=None):
+    """
+    Mosaic the bands of several products onto one grid covering an AOI, window by window.
+
+    Every product is warped onto the target grid on the fly, so AOIs spanning several tiles or
+    UTM zones are covered without holding any scene in memory. Each pixel takes the value of the
+    best product observing it: the least cloudy or the latest product that has data there and,
+    with cloud_mask, is not cloud, shadow or no data in its Scene Classification Layer. Pixels
+    without any clear observation are NaN. Windows run in parallel on the windowed engine.
+
+    Args:
+        products (list): One (band_paths, properties) pair per product, band_paths mapping band name
+            -> band file and properties holding 'cloudcoverpercentage' and 'beginposition', e.g.
+            (Catalog.band_files(uuid), row of the products GeoDataFrame).
+        shapes (geopandas.GeoDataFrame or str): The AOI geometries, or the path of a vector file.
+        output_folder (str): Folder of the mosaicked bands, written as mosaic_<band>.tif.
+        bands (Iterable[str]): Bands to mosaic, e.g. indices.required_bands(['ndvi']).
+        priority (str): 'least_cloudy' or 'latest'.
+        cloud_mask (bool): Use the SCL band of the products to pick clear observations.
+        crs: CRS of the mosaic, defaults to the UTM zone of the AOI.
+        resolution (float): Pixel size of the mosaic.
+        window_budget (int): Maximum bytes held in memory per processing window.
+        workers (int): Number of worker processes, defaults to the number of CPUs.
+
+    Returns:
+        dict: Band name -> path of the mosaicked float32 GeoTIFF.
+
+    Raises:
+        ValueError: If the priority is unknown or there is no product.
+        FileNotFoundError: If a product lacks one of the bands.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown priority {priority}, expected one of {PRIORITIES}")
+    if not products:
+        raise ValueError("No product to mosaic")
+    if isinstance(shapes, str):
+        shapes = gp.read_file(shapes)
+    bands = tuple(band for band in bands if band != 'SCL')
+
+    # Best products first
+    if priority == 'least_cloudy':
+        products = sorted(products, key=lambda product: product[1]['cloudcoverpercentage'])
+    else:
+        products = sorted(products, key=lambda product: parse_date(product[1]['beginposition']), reverse=True)
+
+    crs, transform, width, height = target_grid(shapes, crs, resolution)
+    geometries = [mapping(geometry) for geometry in shapes.to_crs(crs).geometry]
+    inputs = {}
+    keys = []
+    for number, (band_paths, _) in enumerate(products):
+        key = f'p{number}'
+        keys.append(key)
+        needed = bands + (('SCL',) if cloud_mask else ())
+        missing = [band for band in needed if band not in band_paths]
+        if missing:
+            raise FileNotFoundError(f"Bands {missing} not found for product {number}")
+        for band in needed:
+            resampling = Resampling.nearest if band == 'SCL' else Resampling.bilinear
+            inputs[f'{key}_{band}'] = WarpedSource(band_paths[band], crs, transform, width, height,
+                                                   geometries, resampling)
+
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    outputs = {band: os.path.join(output_folder, f'mosaic_{band}.tif') for band in bands}
+    try:
+        run_windowed(partial(_mosaic_kernel, tuple(keys), bands, SCL_MASKED_CLASSES), inputs, outputs,
+                     window_budget=window_budget, workers=workers)
+    finally:
+        close_warped()
+    return outputs
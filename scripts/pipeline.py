@@ -0,0 +1,473 @@
+"""
+Incremental pipeline runner of the crop health monitoring workflow.
+
+The work of a configuration is a graph of tasks: a search per AOI and date range, then per
+selected product a download, a metadata insert, the indices of every AOI it covers, the datacube
+append and the per-field statistics. Each task records a stamp of its parameters and inputs
+(content hash of small files such as AOIs, size and mtime of large ones) and of the outputs it
+wrote; a task whose stamp still matches and whose outputs are unchanged is skipped, so a nightly
+run only downloads and processes the new products. Downloads and metadata inserts run on an I/O
+pool while the processing of the products already downloaded runs on a CPU pool.
+
+Usage:
+    python pipeline.py pipeline.json [--aoi MADRID ...] [--force] [--dry-run]
+
+The Copernicus credentials are read from the COPERNICUS_USER and COPERNICUS_PASSWORD environment
+variables, and the database URI from CHM_DB_URI when it is not in the configuration. See
+pipeline.example.json for the configuration format. Every task is measured as a stage (see
+instrument.py): the metrics are logged as JSON lines and stored in pa.pipeline_runs.
+"""
+import argparse
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from sentinelsat import SentinelAPI, read_geojson, geojson_to_wkt
+
+from bandstack import BandStack
+from catalog import Catalog
+from clipping import clip_all_bands
+from datacube import Datacube
+from db import image_meta_frame, insert_data
+from download_manager import DownloadManager
+from indices import process_indices, required_bands
+from instrument import flush, stage, start_run
+from mosaic import mosaic_products
+from selection import select_scenes
+from zonal import insert_field_stats, zonal_stats
+
+DEFAULT_API_URL = 'https://apihub.copernicus.eu/apihub'
+
+# Input files up to this size are fingerprinted by content, larger ones by size and mtime
+CONTENT_HASH_LIMIT = 1024 * 1024
+
+# A unit of work. run(results) receives the results of its dependencies by key and returns a
+# JSON-serializable result; inputs(results) and outputs(result) list the files it reads and writes.
+Task = namedtuple('Task', ['key', 'run', 'deps', 'inputs', 'outputs', 'params', 'pool', 'always'])
+
+
+def file_fingerprint(path):
+    """
+    Fingerprint of a file: size and mtime, plus the SHA-256 of the content of small files.
+    """
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    fingerprint = [stat.st_size, stat.st_mtime_ns]
+    if stat.st_size <= CONTENT_HASH_LIMIT:
+        with open(path, 'rb') as f:
+            fingerprint.append(hashlib.sha256(f.read()).hexdigest())
+    return fingerprint
+
+
+class StampStore:
+    """
+    Stamps of the completed tasks, one JSON file per task in a folder.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.folder, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, key):
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)
+
+    def put(self, key, stamp, result, outputs):
+        path = self._path(key)
+        tmp = f'{path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'stamp': stamp, 'result': result,
+                       'outputs': {output: file_fingerprint(output) for output in outputs}}, f)
+        os.replace(tmp, path)
+
+
+class Pipeline:
+    """
+    Runs a graph of tasks on an I/O and a CPU thread pool, skipping the tasks that are up to date.
+
+    Tasks may add new tasks while they run (a search adds the tasks of the products it finds).
+    A task starts once all its dependencies are done; if one of them failed, it is not run.
+
+    Args:
+        state_folder (str): Folder of the task stamps.
+        io_workers (int): Tasks running at the same time on the I/O pool (downloads, database).
+        cpu_workers (int): Tasks running at the same time on the CPU pool (processing). The
+            processing tasks already use a process per CPU through the windowed engine.
+        force (bool): Run every task even when up to date.
+        dry_run (bool): Only report the tasks that would run.
+    """
+
+    def __init__(self, state_folder, io_workers=4, cpu_workers=1, force=False, dry_run=False):
+        self.stamps = StampStore(state_folder)
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.force = force
+        self.dry_run = dry_run
+        self.tasks = {}
+        self.status = {}
+        self.results = {}
+        self._lock = threading.Lock()
+
+    def add(self, key, run, deps=(), inputs=None, outputs=None, params=None, pool='cpu', always=False):
+        """
+        Add a task, unless a task with the same key was already added.
+
+        Args:
+            key (str): Unique name of the task, e.g. 'download:<uuid>'.
+            run (callable): run(results) -> result, see Task.
+            deps (Iterable[str]): Keys of the tasks it depends on.
+            inputs (callable): inputs(results) -> paths of the files it reads.
+            outputs (callable): outputs(result) -> paths of the files it writes.
+            params: JSON-serializable parameters; a change of parameters reruns the task.
+            pool (str): 'io' or 'cpu'.
+            always (bool): Run on every run, e.g. the searches for new products.
+        """
+        with self._lock:
+            if key not in self.tasks:
+                self.tasks[key] = Task(key, run, tuple(deps), inputs, outputs, params, pool, always)
+
+    def _stamp(self, task, results):
+        inputs = sorted(task.inputs(results)) if task.inputs else []
+        state = {'params': task.params, 'inputs': {path: file_fingerprint(path) for path in inputs}}
+        return hashlib.sha256(json.dumps(state, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _up_to_date(self, task, stamp):
+        if self.force or task.always:
+            return None
+        stored = self.stamps.get(task.key)
+        if stored is None or stored['stamp'] != stamp:
+            return None
+        # The outputs must still be the files the task wrote
+        for path, fingerprint in stored['outputs'].items():
+            if file_fingerprint(path) != fingerprint:
+                return None
+        return stored
+
+    def _run_task(self, task, results):
+        # Each task is a stage of the run, named after the kind of task
+        with stage(task.key.split(':')[0], task=task.key, pool=task.pool):
+            return task.run(results)
+
+    def run(self):
+        """
+        Run the tasks until none is left.
+
+        Returns:
+            dict: Task key -> 'done', 'skipped', 'failed', 'blocked' (a dependency failed) or, in a
+            dry run, 'would run'.
+        """
+        pools = {'io': ThreadPoolExecutor(max_workers=self.io_workers),
+                 'cpu': ThreadPoolExecutor(max_workers=self.cpu_workers)}
+        running = {}
+        try:
+            while True:
+                with self._lock:
+                    waiting = [task for key, task in self.tasks.items() if key not in self.status]
+                for task in waiting:
+                    states = [self.status.get(dep) for dep in task.deps]
+                    if any(state in ('failed', 'blocked') for state in states):
+                        self.status[task.key] = 'blocked'
+                        print(f"[blocked] {task.key}")
+                        continue
+                    if 'would run' in states:
+                        self.status[task.key] = 'would run'
+                        print(f"[would run] {task.key}")
+                        continue
+                    if not all(state in ('done', 'skipped') for state in states):
+                        continue
+                    results = {dep: self.results.get(dep) for dep in task.deps}
+                    stamp = self._stamp(task, results)
+                    stored = self._up_to_date(task, stamp)
+                    if stored is not None:
+                        self.status[task.key] = 'skipped'
+                        self.results[task.key] = stored['result']
+                        continue
+                    if self.dry_run and not task.always:
+                        print(f"[would run] {task.key}")
+                        self.status[task.key] = 'would run'
+                        continue
+                    self.status[task.key] = 'running'
+                    running[pools[task.pool].submit(self._run_task, task, results)] = (task, stamp)
+
+                if not running:
+                    with self._lock:
+                        left = [key for key in self.tasks if key not in self.status]
+                    if not left:
+                        break
+                    if len(left) == len(waiting):
+                        # Nothing runs and nothing could start: the tasks left depend on unknown tasks
+                        for key in left:
+                            self.status[key] = 'blocked'
+                            print(f"[blocked] {key}")
+                        break
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, stamp = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        self.status[task.key] = 'failed'
+                        print(f"[failed] {task.key}: {error!r}")
+                        continue
+                    self.results[task.key] = result
+                    self.status[task.key] = 'done'
+                    outputs = task.outputs(result) if task.outputs else []
+                    self.stamps.put(task.key, stamp, result, outputs)
+                    print(f"[done] {task.key}")
+                flush()
+        finally:
+            for pool in pools.values():
+                pool.shutdown(wait=True)
+            # The records of the last tasks, and of any earlier flush that failed
+            flush(force=True)
+        return dict(self.status)
+
+
+def _output_paths(result):
+    # Paths of the index rasters of a processing result
+    return list(result['outputs'].values())
+
+
+class Workflow:
+    """
+    Builds the tasks of the crop health monitoring workflow from a configuration.
+
+    Args:
+        config (dict): The configuration, see pipeline.example.json.
+        api (sentinelsat.SentinelAPI): Instance of the Copernicus hub API.
+        pipeline (Pipeline): The pipeline the tasks are added to.
+    """
+
+    def __init__(self, config, api, pipeline):
+        self.config = config
+        self.api = api
+        self.pipeline = pipeline
+        data = config['data_folder']
+        self.folders = {name: os.path.join(data, name) for name in ('processed', 'indices', 'cache', 'cube')}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.catalog = Catalog(os.path.join(data, 'catalog.sqlite'))
+        self.manager = DownloadManager(api, self.folders['cache'], workers=config.get('download_workers', 4))
+        self.db_uri = config.get('db_uri') or os.environ.get('CHM_DB_URI')
+        self.names = tuple(config.get('indices', ('ndvi', 'gci', 'evi')))
+        self.cloud_mask = config.get('cloud_mask', True)
+        self.bands = required_bands(self.names, self.cloud_mask)
+        # A datacube has a single writer: appends to the cube of an AOI are serialized
+        self._cube_locks = {}
+        self._cube_locks_lock = threading.Lock()
+
+    def add_aoi(self, aoi):
+        """
+        Add the search tasks of an AOI, one per date range.
+        """
+        for start, end in aoi['date_ranges']:
+            key = f"search:{aoi['name']}:{start}-{end}"
+            self.pipeline.add(key, lambda results, aoi=aoi, date_range=(start, end): self._search(aoi, date_range),
+                              pool='io', always=True)
+
+    def _search(self, aoi, date_range):
+        footprint = geojson_to_wkt(read_geojson(aoi['search']))
+        cloud = tuple(aoi.get('cloudcoverpercentage', (0, 10)))
+        products = self.catalog.search(self.api, footprint, date_range, cloud)
+        if products.empty:
+            print(f"No image for {aoi['name']} between {date_range[0]} and {date_range[1]}")
+            return []
+        cached = [str(uuid) for uuid in products['uuid'] if self.manager.is_cached(str(uuid), self.bands)]
+        selected = select_scenes(products, footprint, min_coverage=aoi.get('min_coverage', 0.99),
+                                 max_products=aoi.get('max_products'), cached=cached)
+        product_ids = [str(uuid) for uuid in selected['uuid']]
+        if not product_ids:
+            # Nothing usable for this AOI and date range, e.g. no product covering enough of it
+            print(f"[skipped] {aoi['name']} {date_range[0]}-{date_range[1]}: no product selected")
+            return []
+        for product_id in product_ids:
+            self._add_product(product_id)
+        if aoi.get('mosaic'):
+            self._add_mosaic(aoi, date_range, product_ids)
+        else:
+            for product_id, title in zip(product_ids, selected['title']):
+                self._add_processing(aoi, product_id, title)
+        return product_ids
+
+    def _add_product(self, product_id):
+        # Download and metadata tasks are shared by the AOIs covered by the product
+        self.pipeline.add(f'download:{product_id}', lambda results: self._download(product_id),
+                          outputs=lambda result: list(result.values()), params=list(self.bands), pool='io')
+        self.pipeline.add(f'metadata:{product_id}', lambda results: self._metadata(product_id),
+                          params=self.db_uri is not None, pool='io')
+
+    def _download(self, product_id):
+        band_paths = self.manager.fetch([product_id], self.bands)[product_id]
+        self.catalog.set_band_files(product_id, band_paths)
+        return band_paths
+
+    def _metadata(self, product_id):
+        metadata = self.catalog.product_odata(self.api, product_id)
+        if self.db_uri:
+            insert_data(image_meta_frame([metadata]), 'image_meta', self.db_uri)
+        return {'title': metadata['title'], 'date': metadata['date'].isoformat(),
+                'cloud': metadata['Cloud cover percentage']}
+
+    def _processing_params(self, aoi):
+        return {'indices': list(self.names), 'cloud_mask': self.cloud_mask,
+                'quantize': self.config.get('quantize', False),
+                'write_clipped': self.config.get('write_clipped', False), 'mosaic': aoi.get('mosaic', False)}
+
+    def _add_processing(self, aoi, product_id, title):
+        name = aoi['name']
+        download = f'download:{product_id}'
+        metadata = f'metadata:{product_id}'
+        indices_key = f'indices:{name}:{product_id}'
+        self.pipeline.add(
+            indices_key, lambda results: self._indices(aoi, title, results[download]), deps=[download],
+            inputs=lambda results: list(results[download].values()) + [aoi['clip']],
+            outputs=_output_paths, params=self._processing_params(aoi))
+        self._add_outputs(aoi, indices_key, metadata, product_id)
+
+    def _add_outputs(self, aoi, indices_key, metadata, product_id):
+        # Datacube append and field statistics of the indices of one acquisition; the date is
+        # taken from the result of the metadata task
+        name = aoi['name']
+        self.pipeline.add(
+            f'cube:{name}:{product_id}',
+            lambda results: self._cube(name, results[indices_key], results[metadata], product_id),
+            deps=[indices_key, metadata], inputs=lambda results: _output_paths(results[indices_key]))
+        fields = aoi.get('fields') or self.config.get('fields')
+        if fields and self.db_uri:
+            self.pipeline.add(
+                f'stats:{name}:{product_id}',
+                lambda results: self._stats(fields, results[indices_key], results[metadata], product_id),
+                deps=[indices_key, metadata], inputs=lambda results: _output_paths(results[indices_key]) + [fields])
+
+    def _indices(self, aoi, title, band_paths):
+        indices_folder = os.path.join(self.folders['indices'], aoi['name'], title)
+        if self.config.get('write_clipped', False):
+            processed_folder = os.path.join(self.folders['processed'], aoi['name'], title)
+            clip_all_bands(list(band_paths.values()), aoi['clip'], processed_folder)
+            outputs = process_indices(None, self.names, processed_folder=processed_folder,
+                                      indices_folder=indices_folder, quantize=self.config.get('quantize', False),
+                                      cloud_mask=self.cloud_mask)
+        else:
+            stack = BandStack(band_paths, aoi['clip'])
+            outputs = process_indices(None, self.names, indices_folder=indices_folder,
+                                      quantize=self.config.get('quantize', False), cloud_mask=self.cloud_mask,
+                                      stack=stack)
+        return {'outputs': outputs}
+
+    def _add_mosaic(self, aoi, date_range, product_ids):
+        if not product_ids:
+            return
+        name = aoi['name']
+        key = f'mosaic:{name}:{date_range[0]}-{date_range[1]}'
+        downloads = [f'download:{product_id}' for product_id in product_ids]
+        metadata = [f'metadata:{product_id}' for product_id in product_ids]
+        self.pipeline.add(
+            key, lambda results: self._mosaic(aoi, date_range, product_ids, results), deps=downloads + metadata,
+            inputs=lambda results: [path for download in downloads for path in results[download].values()]
+            + [aoi['clip']],
+            outputs=_output_paths, params=dict(self._processing_params(aoi), priority=aoi.get('priority')))
+        # The mosaic is recorded under the best product, its result holds the date
+        self._add_outputs(aoi, key, key, product_ids[0])
+
+    def _mosaic(self, aoi, date_range, product_ids, results):
+        products = [(results[f'download:{product_id}'],
+                     {'cloudcoverpercentage': results[f'metadata:{product_id}']['cloud'],
+                      'beginposition': results[f'metadata:{product_id}']['date']})
+                    for product_id in product_ids]
+        folder = f"{aoi['name']}_{date_range[0]}-{date_range[1]}"
+        mosaic_folder = os.path.join(self.folders['processed'], 'mosaic', folder)
+        mosaic_products(products, aoi['clip'], mosaic_folder, self.bands, priority=aoi.get('priority', 'least_cloudy'),
+                        cloud_mask=self.cloud_mask)
+        outputs = process_indices(None, self.names, processed_folder=mosaic_folder,
+                                  indices_folder=os.path.join(self.folders['indices'], aoi['name'], folder),
+                                  quantize=self.config.get('quantize', False))
+        # Recorded with the date of the latest acquisition
+        latest = max(results[f'metadata:{product_id}']['date'] for product_id in product_ids)
+        return {'outputs': outputs, 'date': latest}
+
+    def _cube(self, name, indices, metadata, product_id):
+        with self._cube_locks_lock:
+            lock = self._cube_locks.setdefault(name, threading.Lock())
+        with lock:
+            # The task only runs again when the index rasters changed: their new values replace the frame
+            Datacube(os.path.join(self.folders['cube'], name)).append_indices(indices['outputs'], metadata['date'],
+                                                                               product_id, replace=True)
+        return None
+
+    def _stats(self, fields, indices, metadata, product_id):
+        stats = zonal_stats(indices['outputs'], fields, cache_folder=os.path.join(self.folders['cache'], 'labels'))
+        return insert_field_stats(stats, product_id, metadata['date'], self.db_uri)
+
+
+def load_config(path):
+    """
+    Read a pipeline configuration file. Relative AOI and field paths are relative to the file.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    base = os.path.dirname(os.path.abspath(path))
+
+    def resolve(value):
+        return os.path.normpath(os.path.join(base, value)) if value else value
+
+    config['fields'] = resolve(config.get('fields'))
+    for aoi in config['aois']:
+        for key in ('search', 'clip', 'fields'):
+            aoi[key] = resolve(aoi.get(key))
+    return config
+
+
+def connect(config):
+    """
+    Connect to the Copernicus hub with the credentials of the environment.
+    """
+    user = os.environ.get('COPERNICUS_USER')
+    password = os.environ.get('COPERNICUS_PASSWORD')
+    if not user or not password:
+        raise SystemExit("Set the COPERNICUS_USER and COPERNICUS_PASSWORD environment variables")
+    return SentinelAPI(user, password, config.get('api_url', DEFAULT_API_URL), show_progressbars=False)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('config', help='JSON configuration file')
+    parser.add_argument('--aoi', nargs='+', help='Only run these AOIs of the configuration')
+    parser.add_argument('--force', action='store_true', help='Run every task, even when up to date')
+    parser.add_argument('--dry-run', action='store_true', help='Search, then list the tasks that would run')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    # The stage metrics are logged as JSON lines
+    logging.basicConfig(format='%(message)s')
+    logging.getLogger('chm.metrics').setLevel(logging.INFO)
+    start_run(config.get('db_uri') or os.environ.get('CHM_DB_URI'))
+    pipeline = Pipeline(os.path.join(config['data_folder'], 'state'), io_workers=config.get('io_workers', 4),
+                        cpu_workers=config.get('cpu_workers', 1), force=args.force, dry_run=args.dry_run)
+    workflow = Workflow(config, connect(config), pipeline)
+    for aoi in config['aois']:
+        if args.aoi is None or aoi['name'] in args.aoi:
+            workflow.add_aoi(aoi)
+    status = pipeline.run()
+
+    counts = {}
+    for state in status.values():
+        counts[state] = counts.get(state, 0) + 1
+    print(", ".join(f"{count} {state}" for state, count in sorted(counts.items())))
+    return 1 if counts.get('failed') else 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
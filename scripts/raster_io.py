@@ -0,0 +1,176 @@
+import os
+
+import numpy as np
+import rasterio
+from rasterio.enums import Resampling
+from rasterio.shutil import copy as copy_dataset
+from rasterio.windows import bounds as window_bounds
+
+# Defaults of the cloud-optimized GeoTIFFs written by the pipeline
+DEFAULT_COMPRESS = 'DEFLATE'
+DEFAULT_BLOCKSIZE = 512
+OVERVIEW_RESAMPLING = Resampling.average
+
+# Nodata of rasters quantized to scaled int16
+INT16_NODATA = -32768
+
+
+def overview_factors(height, width, blocksize=DEFAULT_BLOCKSIZE):
+    """
+    Return the overview decimation factors of a raster, halving it until it fits in one block.
+    """
+    factors = []
+    factor = 2
+    while max(height, width) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+def quantize(array, scale, offset=0.0, nodata=INT16_NODATA):
+    """
+    Convert floating point values to int16 such that value = stored * scale + offset.
+
+    Values that are not finite become nodata, values out of range are clipped.
+    """
+    valid = np.isfinite(array)
+    stored = np.rint((np.where(valid, array, offset) - offset) / scale)
+    np.clip(stored, INT16_NODATA + 1, np.iinfo(np.int16).max, out=stored)
+    stored = stored.astype(np.int16)
+    stored[~valid] = nodata
+    return stored
+
+
+class CogWriter:
+    """
+    Writes a cloud-optimized GeoTIFF: tiled, compressed with a predictor, with nodata and overviews.
+
+    Windows are written to an uncompressed tiled scratch file next to the output, so writes in any
+    order stay cheap. Closing the writer builds the overviews on the scratch file and copies it
+    with its overviews to the output in one pass, overviews first and compressed, which gives the
+    layout of a COG. Used as a context manager, a failed write leaves no output behind.
+
+    With a scale, float values are quantized to int16 (see quantize) and the scale and offset are
+    stored in the file, so readers get the value back as stored * scale + offset.
+
+    Args:
+        path (str): Path of the output GeoTIFF.
+        height (int): Number of rows.
+        width (int): Number of columns.
+        crs: CRS of the raster.
+        transform (Affine): Transform of the raster.
+        count (int): Number of bands.
+        dtype (str): Data type of the bands, ignored when quantizing.
+        nodata (float): Nodata value. Defaults to NaN for floats and to INT16_NODATA when quantizing.
+        compress (str): GDAL compression, e.g. 'DEFLATE', 'ZSTD' or 'LZW'.
+        blocksize (int): Size of the internal tiles.
+        scale (float): Quantization step, None to keep the data type.
+        offset (float): Quantization offset.
+    """
+
+    def __init__(self, path, height, width, crs, transform, count=1, dtype='float32', nodata=None,
+                 compress=DEFAULT_COMPRESS, blocksize=DEFAULT_BLOCKSIZE, scale=None, offset=0.0):
+        self.path = path
+        self.scale = scale
+        self.offset = offset
+        self.compress = compress
+        self.blocksize = blocksize
+        if scale is not None:
+            dtype = 'int16'
+            nodata = INT16_NODATA if nodata is None else nodata
+        elif nodata is None and np.issubdtype(np.dtype(dtype), np.floating):
+            nodata = np.nan
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+        self._scratch = f'{path}.tmp.tif'
+        self._dst = rasterio.open(self._scratch, 'w', driver='GTiff', height=height, width=width, count=count,
+                                  dtype=self.dtype, crs=crs, transform=transform, nodata=nodata, tiled=True,
+                                  blockxsize=blocksize, blockysize=blocksize, BIGTIFF='IF_SAFER')
+        if scale is not None:
+            self._dst.scales = (scale,) * count
+            self._dst.offsets = (offset,) * count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, array, indexes=None, window=None):
+        if self.scale is not None:
+            array = quantize(array, self.scale, self.offset, self.nodata)
+        elif np.ma.isMaskedArray(array):
+            array = array.filled(self.nodata)
+        self._dst.write(array.astype(self.dtype, copy=False), indexes, window=window)
+
+    def close(self):
+        """
+        Build the overviews and write the output file.
+        """
+        if self._dst.closed:
+            return
+        factors = overview_factors(self._dst.height, self._dst.width, self.blocksize)
+        if factors:
+            self._dst.build_overviews(factors, OVERVIEW_RESAMPLING)
+        self._dst.close()
+        predictor = 3 if np.issubdtype(self.dtype, np.floating) else 2
+        try:
+            copy_dataset(self._scratch, self.path, driver='GTiff', copy_src_overviews=True, tiled=True,
+                         blockxsize=self.blocksize, blockysize=self.blocksize, compress=self.compress,
+                         predictor=predictor, BIGTIFF='IF_SAFER')
+        finally:
+            os.remove(self._scratch)
+
+    def abort(self):
+        """
+        Discard the file without writing the output.
+        """
+        if not self._dst.closed:
+            self._dst.close()
+        if os.path.exists(self._scratch):
+            os.remove(self._scratch)
+
+
+def read_values(src, indexes=1, window=None):
+    """
+    Read a band as float32 with nodata as NaN, undoing the quantization of scaled rasters.
+    """
+    data = src.read(indexes, window=window, masked=True)
+    values = data.astype(np.float32).filled(np.nan)
+    scale, offset = src.scales[0], src.offsets[0]
+    if scale != 1 or offset != 0:
+        values *= scale
+        values += offset
+    return values
+
+
+def read_on_grid(src, window, transform, resampling=Resampling.nearest, fill_value=0):
+    """
+    Read the pixels of a raster under a window of another grid in the same CRS.
+
+    A window aligned on the pixels of the raster at the same resolution is a plain read. Otherwise
+    the raster is resampled to the shape of the window, and parts beyond the raster are filled.
+
+    Args:
+        src (rasterio.DatasetReader): The open raster.
+        window (Window): Window of the grid.
+        transform (Affine): Transform of the grid.
+        resampling (Resampling): Resampling when the resolutions differ.
+        fill_value (float): Value of the pixels beyond the raster.
+
+    Returns:
+        numpy.ndarray: The first band over the window.
+    """
+    shape = (int(window.height), int(window.width))
+    src_window = src.window(*window_bounds(window, transform))
+    inside = (src_window.col_off > -0.5 and src_window.row_off > -0.5
+              and src_window.col_off + src_window.width < src.width + 0.5
+              and src_window.row_off + src_window.height < src.height + 0.5)
+    if inside and np.allclose(src.res, (abs(transform.a), abs(transform.e))):
+        return src.read(1, window=src_window.round_offsets().round_lengths())
+    # Boundless reads go through a VRT, only used for windows reaching beyond the raster
+    return src.read(1, window=src_window, out_shape=shape, resampling=resampling,
+                    boundless=not inside, fill_value=fill_value)
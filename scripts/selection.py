@@ -0,0 +1,79 @@
+import pandas as pd
+from shapely import wkt
+from shapely.geometry.base import BaseGeometry
+from shapely.strtree import STRtree
+
+
+def _query(tree, geometries, aoi):
+    # STRtree.query returns indices with shapely 2 and geometries with shapely 1.8
+    hits = tree.query(aoi)
+    if len(hits) and isinstance(hits[0], BaseGeometry):
+        positions = {id(geometry): i for i, geometry in enumerate(geometries)}
+        return [positions[id(hit)] for hit in hits]
+    return [int(i) for i in hits]
+
+
+def select_scenes(products_gdf, aoi, min_coverage=0.99, max_products=None, cached=(),
+                  cloud_column='cloudcoverpercentage', date_column='beginposition', recency_half_life=30):
+    """
+    Choose the smallest set of products that covers an AOI, favouring clear, recent and cached scenes.
+
+    Candidate footprints are indexed in an STRtree to find the ones intersecting the AOI. Products
+    are then picked greedily: each step takes the product with the best ratio of newly covered AOI
+    area times quality to download cost, until the AOI coverage reaches min_coverage or no product
+    adds coverage. Quality is the clear-sky fraction (1 - cloud cover) halved every
+    recency_half_life days older than the newest candidate. Products already cached locally cost
+    a tenth of a download.
+
+    Args:
+        products_gdf (geopandas.GeoDataFrame): Query results, as returned by SentinelAPI.to_geodataframe.
+        aoi (str or shapely geometry): The AOI, as WKT or a geometry, in the CRS of the footprints.
+        min_coverage (float): Fraction of the AOI area to cover before stopping.
+        max_products (int): Maximum number of products to select, None for no limit.
+        cached (Iterable[str]): UUIDs of the products already downloaded.
+        cloud_column (str): Column of the cloud cover percentage.
+        date_column (str): Column of the acquisition date.
+        recency_half_life (float): Age in days that halves the quality of a product.
+
+    Returns:
+        geopandas.GeoDataFrame: The selected products in order of selection, with a 'coverage'
+        column holding the fraction of the AOI each one newly covers.
+    """
+    if isinstance(aoi, str):
+        aoi = wkt.loads(aoi)
+    if products_gdf.empty or aoi.is_empty:
+        return products_gdf.iloc[0:0].assign(coverage=[])
+
+    geometries = list(products_gdf.geometry)
+    candidates = [i for i in _query(STRtree(geometries), geometries, aoi) if geometries[i].intersects(aoi)]
+
+    cloud = products_gdf[cloud_column].fillna(100).to_numpy(dtype=float)
+    dates = pd.to_datetime(products_gdf[date_column]) if date_column in products_gdf else None
+    cached = {str(uuid) for uuid in cached}
+    uuids = [str(uuid) for uuid in products_gdf['uuid']] if 'uuid' in products_gdf else [str(i) for i in products_gdf.index]
+
+    quality = {}
+    for i in candidates:
+        value = max(1 - cloud[i] / 100, 0.01)
+        if dates is not None:
+            age_days = (dates.max() - dates.iloc[i]).total_seconds() / 86400
+            value *= 0.5 ** (age_days / recency_half_life)
+        quality[i] = value / (0.1 if uuids[i] in cached else 1.0)
+
+    # Restrict the footprints to the AOI once, the greedy loop only works on these pieces
+    pieces = {i: geometries[i].intersection(aoi) for i in candidates}
+    uncovered = aoi
+    selected, coverage = [], []
+    while candidates and 1 - uncovered.area / aoi.area < min_coverage:
+        if max_products is not None and len(selected) >= max_products:
+            break
+        gains = {i: pieces[i].intersection(uncovered).area / aoi.area for i in candidates}
+        best = max(candidates, key=lambda i: gains[i] * quality[i])
+        if gains[best] <= 1e-9:
+            break
+        selected.append(best)
+        coverage.append(gains[best])
+        uncovered = uncovered.difference(pieces[best])
+        candidates.remove(best)
+
+    return products_gdf.iloc[selected].assign(coverage=coverage)
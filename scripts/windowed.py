@@ -0,0 +1,195 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+
+from instrument import add_pixels
+from raster_io import DEFAULT_COMPRESS, CogWriter
+
+# Default memory budget for the arrays of one window (inputs, outputs and temporaries)
+DEFAULT_WINDOW_BUDGET = 64 * 1024 * 1024
+
+# Datasets opened by each thread of a process, kept open between windows. GDAL handles must not
+# be shared between threads, and a run only closes the handles of its own thread.
+_local = threading.local()
+
+
+def _datasets():
+    if not hasattr(_local, 'datasets'):
+        _local.datasets = {}
+    return _local.datasets
+
+
+def plan_windows(height, width, block_shape=(1, 1), bytes_per_pixel=4, window_budget=DEFAULT_WINDOW_BUDGET):
+    """
+    Split a raster grid into block-aligned windows that fit in a memory budget.
+
+    Windows are full-width strips whose height is a multiple of the block height. If a single
+    strip of one block height does not fit in the budget, strips are further split into columns
+    that are a multiple of the block width.
+
+    Args:
+        height (int): Number of rows of the raster.
+        width (int): Number of columns of the raster.
+        block_shape (tuple): (rows, cols) of the internal blocks of the source raster.
+        bytes_per_pixel (int): Bytes held in memory per pixel of a window, over all arrays.
+        window_budget (int): Maximum bytes per window. None reads the whole raster as one window.
+
+    Returns:
+        list[Window]: Windows covering the grid in row-major order.
+    """
+    if window_budget is None:
+        return [Window(0, 0, width, height)]
+
+    block_rows, block_cols = block_shape
+    pixels = max(window_budget // bytes_per_pixel, 1)
+
+    rows = (pixels // width) // block_rows * block_rows
+    if rows >= block_rows:
+        cols = width
+    else:
+        rows = min(block_rows, height)
+        cols = max((pixels // rows) // block_cols * block_cols, block_cols)
+
+    windows = []
+    for row_off in range(0, height, rows):
+        for col_off in range(0, width, cols):
+            windows.append(Window(col_off, row_off, min(cols, width - col_off), min(rows, height - row_off)))
+    return windows
+
+
+def _open(path):
+    # Reuse the dataset handle for every window a worker processes
+    datasets = _datasets()
+    if path not in datasets:
+        datasets[path] = rasterio.open(path)
+    return datasets[path]
+
+
+def _read(source, window):
+    # An input is either a raster path or a source object with its own read(window), see bandstack
+    if isinstance(source, str):
+        return _open(source).read(1, window=window)
+    return source.read(window)
+
+
+def _run_window(kernel, inputs, window, mask=None, transform=None):
+    if mask is None:
+        arrays = {name: _read(source, window) for name, source in inputs.items()}
+        return kernel(**arrays)
+
+    masked = mask.read(window, transform)
+    if masked.all():
+        # Nothing to compute, the inputs of the window are not even read
+        return None
+    arrays = {name: _read(source, window) for name, source in inputs.items()}
+    if not masked.any():
+        return kernel(**arrays)
+
+    # The kernel works per pixel, so it runs on the unmasked pixels only
+    keep = ~masked
+    results = kernel(**{name: array[keep] for name, array in arrays.items()})
+    filled = {}
+    for name, values in results.items():
+        filled[name] = np.full(masked.shape, np.nan, dtype=np.float32)
+        filled[name][keep] = values
+    return filled
+
+
+def run_windowed(kernel, inputs, outputs, window_budget=DEFAULT_WINDOW_BUDGET, workers=None, scales=None,
+                 compress=DEFAULT_COMPRESS, mask=None):
+    """
+    Apply a per-pixel kernel to a set of aligned rasters window by window.
+
+    The windows are spread over a process pool and written to the outputs in order, so the
+    result is the same as running the kernel on the whole arrays at once. At most two windows
+    per worker are in flight, which bounds peak memory by the window budget instead of the
+    raster size.
+
+    Args:
+        kernel (callable): Module-level function taking one keyword argument per input and
+            returning a dict of output name -> array of the same shape.
+        inputs (dict): Keyword name -> path of the input rasters, or a picklable source object with
+            crs, transform, width, height and block_shape attributes and a read(window) method
+            (e.g. bandstack.WindowSource). All inputs share one grid.
+        outputs (dict): Output name -> path of the float32 cloud-optimized GeoTIFF to write.
+        window_budget (int): Maximum bytes per window. None processes the whole raster at once.
+        workers (int): Number of worker processes. Defaults to the number of CPUs; 1 runs in-process.
+        scales (dict): Output name -> quantization step of the outputs stored as scaled int16.
+        compress (str): Compression of the outputs.
+        mask: Optional picklable object whose read(window, transform) returns a boolean array, True
+            for the pixels to leave out (e.g. cloudmask.SclMask). Masked pixels are NaN in the
+            outputs and windows that are entirely masked are skipped without reading the inputs.
+
+    Returns:
+        None
+    """
+    reference = next(iter(inputs.values()))
+    if isinstance(reference, str):
+        with rasterio.open(reference) as src:
+            height, width = src.height, src.width
+            crs, transform = src.crs, src.transform
+            block_shape = src.block_shapes[0]
+    else:
+        height, width = reference.height, reference.width
+        crs, transform = reference.crs, reference.transform
+        block_shape = reference.block_shape
+
+    bytes_per_pixel = 4 * (len(inputs) + len(outputs) + 2)
+    windows = plan_windows(height, width, block_shape, bytes_per_pixel, window_budget)
+    workers = workers or os.cpu_count() or 1
+
+    scales = scales or {}
+    destinations = {
+        name: CogWriter(path, height, width, crs, transform, compress=compress, scale=scales.get(name))
+        for name, path in outputs.items()
+    }
+    completed = False
+    try:
+        if workers == 1 or len(windows) == 1:
+            for window in windows:
+                _write_window(destinations, window, _run_window(kernel, inputs, window, mask, transform))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                pending = deque()
+                for window in windows:
+                    pending.append((window, executor.submit(_run_window, kernel, inputs, window, mask, transform)))
+                    if len(pending) >= 2 * workers:
+                        done_window, future = pending.popleft()
+                        _write_window(destinations, done_window, future.result())
+                while pending:
+                    done_window, future = pending.popleft()
+                    _write_window(destinations, done_window, future.result())
+        completed = True
+        add_pixels(height * width)
+    finally:
+        for dst in destinations.values():
+            # Overviews are built and the outputs written only when every window succeeded
+            if completed:
+                dst.close()
+            else:
+                dst.abort()
+        close_datasets()
+
+
+def close_datasets():
+    """
+    Close the datasets opened by the current thread.
+    """
+    datasets = _datasets()
+    for dataset in datasets.values():
+        dataset.close()
+    datasets.clear()
+
+
+def _write_window(destinations, window, results):
+    if results is None:
+        # Fully masked window
+        empty = np.full((int(window.height), int(window.width)), np.nan, dtype=np.float32)
+        results = {name: empty for name in destinations}
+    for name, dst in destinations.items():
+        dst.write(results[name].astype(np.float32), 1, window=window)
@@ -0,0 +1,47 @@
+"""
+Tests of the validation of the request arguments of the app endpoints.
+
+Malformed arguments are rejected with a 400 before any query, so no database is needed.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'App'))
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setenv('CHM_DATA_FOLDER', str(tmp_path))
+    from app import app
+    return app.test_client()
+
+
+@pytest.mark.parametrize('bbox', ['1,2,3', '1,2,3,4,5', 'a,b,c,d', '1,2,,4'])
+def test_footprints_reject_invalid_bbox(client, bbox):
+    response = client.get('/api/footprints', query_string={'bbox': bbox})
+    assert response.status_code == 400
+    assert 'bbox' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('zoom', ['x', '-1', '2.5', '99'])
+def test_footprints_reject_invalid_zoom(client, zoom):
+    response = client.get('/api/footprints', query_string={'zoom': zoom})
+    assert response.status_code == 400
+    assert 'zoom' in response.get_json()['error']
+
+
+@pytest.mark.parametrize('url', ['/api/footprints?max_cloud=low', '/api/images?min_cloud=low',
+                                 '/api/images?max_cloud=10%25'])
+def test_reject_invalid_cloud_filters(client, url):
+    assert client.get(url).status_code == 400
+
+
+@pytest.mark.parametrize('after', ['2022-09-01', 'yesterday|3fa85f64-5717-4562-b3fc-2c963f66afa6',
+                                   '2022-09-01T10:56:31|not-a-uuid'])
+def test_images_reject_invalid_cursor(client, after):
+    response = client.get('/api/images', query_string={'after': after})
+    assert response.status_code == 400
+    assert 'cursor' in response.get_json()['error']
@@ -0,0 +1,93 @@
+"""
+Tests of the clipping of bands to AOIs.
+"""
+import os
+import sys
+
+import geopandas as gp
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+from rasterio.io import DatasetReader
+from rasterio.windows import Window
+from shapely.geometry import box
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+from clipping import clip_aois, clip_raster, group_windows  # noqa: E402
+
+CRS = 'EPSG:32630'
+ORIGIN = (399960.0, 4500000.0)
+SIZE = 1000
+
+
+@pytest.fixture
+def band(tmp_path):
+    path = str(tmp_path / 'T30TVK_20220901T105631_B04_10m.tif')
+    data = (np.arange(SIZE * SIZE, dtype=np.uint32) % 60000 + 1).astype(np.uint16).reshape(SIZE, SIZE)
+    with rasterio.open(path, 'w', driver='GTiff', height=SIZE, width=SIZE, count=1, dtype='uint16', crs=CRS,
+                       transform=Affine(10, 0, ORIGIN[0], 0, -10, ORIGIN[1]), nodata=0) as dst:
+        dst.write(data, 1)
+    return path
+
+
+def write_aoi(folder, name, col, row, size):
+    # Square AOI of size pixels with its upper left corner on pixel (col, row)
+    left, top = ORIGIN[0] + col * 10, ORIGIN[1] - row * 10
+    path = os.path.join(folder, f'{name}.geojson')
+    gp.GeoDataFrame({'id': [name]}, geometry=[box(left, top - size * 10, left + size * 10, top)],
+                    crs=CRS).to_file(path, driver='GeoJSON')
+    return path
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # Shapes of the windows decoded by DatasetReader.read
+    shapes = []
+    read = DatasetReader.read
+
+    def spy(self, *args, **kwargs):
+        data = read(self, *args, **kwargs)
+        shapes.append(data.shape[-2:])
+        return data
+    monkeypatch.setattr(DatasetReader, 'read', spy)
+    return shapes
+
+
+def test_far_apart_aois_are_read_separately(band, tmp_path, reads):
+    aois = str(tmp_path / 'aois')
+    os.makedirs(aois)
+    write_aoi(aois, 'north_west', 10, 10, 50)
+    write_aoi(aois, 'south_east', 900, 900, 50)
+    clipped = clip_aois([band], aois, str(tmp_path / 'clipped'), workers=1)
+
+    assert sorted(clipped) == ['north_west', 'south_east']
+    # Two windows of the AOIs, not the 940 x 940 union spanning the tile
+    assert sorted(reads) == [(50, 50), (50, 50)]
+
+    # Same pixels as clipping each AOI on its own
+    for name in clipped:
+        expected = str(tmp_path / f'{name}.tif')
+        clip_raster(band, os.path.join(aois, f'{name}.geojson'), expected)
+        with rasterio.open(os.path.join(clipped[name], os.path.basename(band))) as batch, \
+                rasterio.open(expected) as single:
+            assert batch.transform == single.transform
+            assert np.array_equal(batch.read(), single.read())
+
+
+def test_overlapping_aois_are_read_once(band, tmp_path, reads):
+    aois = str(tmp_path / 'aois')
+    os.makedirs(aois)
+    write_aoi(aois, 'first', 100, 100, 50)
+    write_aoi(aois, 'second', 130, 120, 50)
+    clip_aois([band], aois, str(tmp_path / 'clipped'), workers=1)
+    assert reads == [(70, 80)]
+
+
+def test_group_windows_merges_touching_windows_transitively():
+    groups = group_windows({'a': Window(0, 0, 10, 10), 'b': Window(10, 0, 10, 10), 'c': Window(20, 5, 5, 5),
+                            'd': Window(100, 100, 5, 5)})
+    assert sorted((sorted(names), window.flatten()) for window, names in groups) == [
+        (['a', 'b', 'c'], (0, 0, 25, 10)), (['d'], (100, 100, 5, 5))]
@@ -0,0 +1,148 @@
+"""
+Tests of the resumable downloads of download_manager against a local HTTP server.
+
+The server serves one file and can be told to cut a response short, to ignore Range headers or to
+corrupt a response, so the resume, 416 and checksum retry branches of download_file run for real.
+
+Usage:
+    python -m pytest tests
+"""
+import hashlib
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+from download_manager import DownloadManager, download_file  # noqa: E402
+
+# Four download chunks, a truncated response still leaves whole chunks in the part file
+CONTENT = bytes(range(256)) * 16384
+MD5 = hashlib.md5(CONTENT).hexdigest()
+
+
+class FileHandler(BaseHTTPRequestHandler):
+    # Behaviour of the next responses, consumed in order, then plain (Range aware) responses:
+    # 'truncate' sends half of the requested bytes then closes, 'corrupt' sends wrong bytes and
+    # 'ignore_range' sends the whole file with a 200 whatever the Range header
+    script = []
+    requests = []
+
+    def do_GET(self):
+        type(self).requests.append(self.headers.get('Range'))
+        action = type(self).script.pop(0) if type(self).script else None
+        start = 0
+        if self.headers.get('Range') and action != 'ignore_range':
+            start = int(self.headers['Range'].split('=')[1].rstrip('-'))
+            if start >= len(CONTENT):
+                self.send_response(416)
+                self.send_header('Content-Range', f'bytes */{len(CONTENT)}')
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+        body = CONTENT[start:]
+        if action == 'corrupt':
+            body = bytes(len(body))
+        self.send_response(206 if start else 200)
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(CONTENT) - 1}/{len(CONTENT)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if action == 'truncate':
+            self.wfile.write(body[:len(body) // 2])
+            self.wfile.flush()
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    FileHandler.script = []
+    FileHandler.requests = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FileHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/T30TVK_B04_10m.jp2'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_resumes_truncated_download(server, tmp_path):
+    FileHandler.script = ['truncate']
+    dest = str(tmp_path / 'band.jp2')
+    assert download_file(server, dest, checksum=MD5) == dest
+    assert read(dest) == CONTENT
+    assert not os.path.exists(dest + '.part')
+    # The second request continues after the bytes received by the first
+    assert FileHandler.requests == [None, f'bytes={len(CONTENT) // 2}-']
+
+
+def test_resumes_existing_part_file(server, tmp_path):
+    dest = str(tmp_path / 'band.jp2')
+    with open(dest + '.part', 'wb') as f:
+        f.write(CONTENT[:1000])
+    download_file(server, dest, checksum=MD5)
+    assert read(dest) == CONTENT
+    assert FileHandler.requests == ['bytes=1000-']
+
+
+def test_part_file_is_rewritten_when_range_is_ignored(server, tmp_path):
+    FileHandler.script = ['ignore_range']
+    dest = str(tmp_path / 'band.jp2')
+    with open(dest + '.part', 'wb') as f:
+        f.write(CONTENT[:1000])
+    download_file(server, dest, checksum=MD5)
+    assert read(dest) == CONTENT
+
+
+def test_complete_part_file_is_kept_on_416(server, tmp_path):
+    dest = str(tmp_path / 'band.jp2')
+    with open(dest + '.part', 'wb') as f:
+        f.write(CONTENT)
+    download_file(server, dest, checksum=MD5)
+    assert read(dest) == CONTENT
+    assert FileHandler.requests == [f'bytes={len(CONTENT)}-']
+
+
+def test_checksum_mismatch_downloads_again(server, tmp_path):
+    FileHandler.script = ['corrupt']
+    dest = str(tmp_path / 'band.jp2')
+    download_file(server, dest, checksum=MD5)
+    assert read(dest) == CONTENT
+    # The corrupted part file is dropped, the retry starts from scratch
+    assert FileHandler.requests == [None, None]
+
+
+def test_checksum_never_matching_fails(server, tmp_path):
+    FileHandler.script = ['corrupt'] * 3
+    dest = str(tmp_path / 'band.jp2')
+    with pytest.raises(IOError):
+        download_file(server, dest, checksum=MD5, retries=3)
+    assert not os.path.exists(dest)
+    assert len(FileHandler.requests) == 3
+
+
+def test_manager_caches_resolved_downloads(server, tmp_path):
+    FileHandler.script = ['truncate']
+    manager = DownloadManager(None, str(tmp_path / 'cache'), workers=2, resolve=lambda uuid, band: (server, MD5))
+    first = manager.fetch(['product'], ['B04'])
+    assert read(first['product']['B04']) == CONTENT
+    assert manager.is_cached('product', ['B04'])
+
+    # Cached band files are returned without any request
+    FileHandler.requests = []
+    assert manager.fetch(['product'], ['B04']) == first
+    assert FileHandler.requests == []
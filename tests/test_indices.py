@@ -0,0 +1,62 @@
+"""
+Tests of the band matching and of the indices of mixed-resolution bands.
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+import rasterio
+from affine import Affine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+from indices import match_bands, process_indices  # noqa: E402
+
+PREFIX = 'T30TVK_20220901T105631'
+
+
+def write_band(folder, band, resolution, value, size=60):
+    # A band of a 600 m square tile at a resolution in metres
+    count = size * 10 // resolution
+    path = os.path.join(folder, f'{PREFIX}_{band}_{resolution}m.tif')
+    with rasterio.open(path, 'w', driver='GTiff', height=count, width=count, count=1, dtype='uint16',
+                       crs='EPSG:32630', transform=Affine(resolution, 0, 399960, 0, -resolution, 4500000),
+                       nodata=0) as dst:
+        dst.write(np.full((1, count, count), value, dtype=np.uint16))
+    return path
+
+
+def test_finest_resolution_of_a_band_is_kept():
+    paths = [f'{PREFIX}_B05_20m.jp2', f'{PREFIX}_B05_60m.jp2', f'{PREFIX}_B02_10m.jp2', f'{PREFIX}_B02_20m.jp2',
+             f'{PREFIX}_B02_60m.jp2', f'{PREFIX}_B8A_20m.jp2']
+    for order in (paths, paths[::-1]):
+        assert match_bands(order) == {'B05': f'{PREFIX}_B05_20m.jp2', 'B02': f'{PREFIX}_B02_10m.jp2',
+                                      'B8A': f'{PREFIX}_B8A_20m.jp2'}
+
+
+def test_band_token_and_side_files():
+    assert match_bands(['mosaic_B04.tif', 'mosaic_B04.tif.aux.xml', f'{PREFIX}_B04_10m.tif.tmp.tif',
+                        'AB04C_B03.tif']) == {'B04': 'mosaic_B04.tif', 'B03': 'AB04C_B03.tif'}
+
+
+def test_same_band_and_resolution_twice_is_ambiguous():
+    with pytest.raises(ValueError):
+        match_bands([f'a/{PREFIX}_B04_10m.tif', f'a/{PREFIX}_B04_10m.jp2'])
+
+
+def test_ndre_uses_the_20m_bands_next_to_60m_ones(tmp_path):
+    processed = str(tmp_path / 'processed')
+    os.makedirs(processed)
+    write_band(processed, 'B04', 10, 800)
+    write_band(processed, 'B8A', 20, 3000)
+    write_band(processed, 'B05', 20, 1000)
+    # Coarser copies with other values, which must not be read
+    write_band(processed, 'B8A', 60, 1000)
+    write_band(processed, 'B05', 60, 3000)
+    outputs = process_indices(None, ['ndre'], processed_folder=processed, indices_folder=str(tmp_path / 'indices'),
+                              workers=1)
+    with rasterio.open(outputs['ndre']) as src:
+        assert src.res == (20.0, 20.0)
+        assert np.allclose(src.read(1), (3000 - 1000) / (3000 + 1000))
@@ -0,0 +1,78 @@
+"""
+Tests of the incremental pipeline runner and of the datacube tasks of the workflow.
+"""
+import os
+import sys
+
+import numpy as np
+import rasterio
+from affine import Affine
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+from datacube import Datacube  # noqa: E402
+from pipeline import Pipeline, Workflow  # noqa: E402
+
+PRODUCT_ID = '3fa85f64-5717-4562-b3fc-2c963f66afa6'
+
+
+def write_index(path, value):
+    with rasterio.open(path, 'w', driver='GTiff', height=8, width=8, count=1, dtype='float32', crs='EPSG:32630',
+                       transform=Affine(10, 0, 399960, 0, -10, 4500000), nodata=np.nan) as dst:
+        dst.write(np.full((1, 8, 8), value, dtype=np.float32))
+
+
+def run_workflow(data_folder, value):
+    # The indices task of one acquisition writes a raster of value; its parameters change with the
+    # value, as after a change of processing options
+    pipeline = Pipeline(os.path.join(data_folder, 'state'))
+    workflow = Workflow({'data_folder': data_folder}, None, pipeline)
+    ndvi = os.path.join(data_folder, 'indices', 'T30TVK_ndvi.tif')
+    indices_key = f'indices:FIELD:{PRODUCT_ID}'
+    metadata_key = f'metadata:{PRODUCT_ID}'
+
+    def indices(results):
+        write_index(ndvi, value)
+        return {'outputs': {'ndvi': ndvi}}
+    pipeline.add(indices_key, indices, outputs=lambda result: list(result['outputs'].values()), params={'value': value})
+    pipeline.add(metadata_key, lambda results: {'date': '2022-09-01T10:56:31'}, pool='io')
+    workflow._add_outputs({'name': 'FIELD'}, indices_key, metadata_key, PRODUCT_ID)
+    return pipeline.run()
+
+
+def test_rerun_of_indices_replaces_the_cube_frame(tmp_path):
+    data_folder = str(tmp_path)
+    cube_key = f'cube:FIELD:{PRODUCT_ID}'
+    assert run_workflow(data_folder, 0.25)[cube_key] == 'done'
+    assert run_workflow(data_folder, 0.25)[cube_key] == 'skipped'
+
+    status = run_workflow(data_folder, 0.75)
+    assert status[cube_key] == 'done'
+    cube = Datacube(os.path.join(data_folder, 'cube', 'FIELD'))
+    frames = cube.read('ndvi')
+    # One acquisition, with the values of the last run
+    assert frames.shape == (1, 8, 8)
+    assert np.allclose(frames, 0.75)
+
+
+def test_append_keeps_or_replaces_an_acquisition(tmp_path):
+    first, second = str(tmp_path / 'first.tif'), str(tmp_path / 'second.tif')
+    write_index(first, 0.1)
+    write_index(second, 0.2)
+    cube = Datacube(str(tmp_path / 'cube'), chunk_size=4)
+    assert cube.append('ndvi', first, '2022-09-01', 'a')
+    assert cube.append('ndvi', first, '2022-09-06', 'b')
+    assert not cube.append('ndvi', second, '2022-09-01', 'a')
+    assert cube.append('ndvi', second, '2022-09-01', 'a', replace=True)
+
+    frames = Datacube(str(tmp_path / 'cube')).read('ndvi')
+    assert frames.shape == (2, 8, 8)
+    assert np.allclose(frames[0], 0.2) and np.allclose(frames[1], 0.1)
+
+
+def test_mosaic_without_products_adds_no_task(tmp_path):
+    pipeline = Pipeline(str(tmp_path / 'state'))
+    workflow = Workflow({'data_folder': str(tmp_path)}, None, pipeline)
+    workflow._add_mosaic({'name': 'FIELD', 'mosaic': True}, ('2022-09-01', '2022-09-30'), [])
+    assert pipeline.tasks == {}